@@ -0,0 +1,637 @@
+# coding: utf-8
+"""
+    bench_makestatic
+    ~~~~~~~~~~~~~~~~
+
+    Benchmarks for Flask-MakeStatic, run ``python bench_makestatic.py`` or
+    ``make bench``.
+
+    Use ``--json results.json`` to write the results to a file and
+    ``--compare results.json`` to compare the results with those of a
+    previous run. The benchmarks working on synthetic asset trees use trees
+    with 1000 and 10000 files by default, use ``--files 1000,100000`` to
+    choose other sizes and ``--only compile,watch`` to run only some of the
+    benchmarks.
+
+    :copyright: 2013 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import threading
+from fnmatch import fnmatch
+from optparse import OptionParser
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+
+from flask import Flask
+from flask.ext import makestatic
+from flask.ext.makestatic import (
+    MakeStatic, _ConfigParser, _CommandTemplate, run_command
+)
+from flask.ext.makestatic._compat import StringIO
+from flask.ext.makestatic.watcher import Signal, create_watcher
+
+
+def timeit(function, repeat=3):
+    """
+    Calls `function` `repeat` times and returns the shortest time a call took
+    in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def generate_glob_rules(count):
+    """
+    Returns `count` glob patterns, of the kinds commonly found in
+    `assets.cfg` files.
+    """
+    patterns = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            patterns.append('*.ext%d' % i)
+        elif kind == 1:
+            patterns.append('directory%d/*' % i)
+        elif kind == 2:
+            patterns.append('directory%d/*.ext%d' % (i, i))
+        else:
+            patterns.append('file%d.*' % i)
+    patterns.append('*')
+    return patterns
+
+
+def generate_filenames(count, rule_count, seed=0):
+    random_ = random.Random(seed)
+    filenames = []
+    for i in range(count):
+        directory = 'directory%d' % random_.randrange(rule_count)
+        extension = 'ext%d' % random_.randrange(rule_count)
+        filenames.append('%s/file%d.%s' % (directory, i, extension))
+    return filenames
+
+
+def create_config(patterns):
+    return ''.join('[%s]\ncp {asset} {static}\n' % pattern
+                   for pattern in patterns)
+
+
+def generate_config(rule_count, filepattern_format='regex'):
+    """
+    Returns the source of a synthetic `assets.cfg` file with `rule_count`
+    rules, each with an option, a command and a comment.
+    """
+    if filepattern_format == 'regex':
+        pattern = r'directory%d/.*\.ext%d'
+    else:
+        pattern = 'directory%d/*.ext%d'
+    return ''.join(
+        '[%s]\n'
+        ':outputs {static_base}.out\n'
+        'cp {asset} {static_base}.out # copy\n'
+        '\n' % (pattern % (i, i))
+        for i in range(rule_count)
+    )
+
+
+def generate_tree(assets_dir, file_count, layout='flat', seed=0):
+    """
+    Creates `file_count` small files with the extensions ``.css``, ``.js``
+    and ``.txt`` in `assets_dir` and returns their paths. With the ``'flat'``
+    `layout` all files are created directly in `assets_dir`, with the
+    ``'deep'`` layout they are spread over a tree of directories, four levels
+    deep.
+    """
+    random_ = random.Random(seed)
+    extensions = ['css', 'js', 'txt']
+    filenames = []
+    for i in range(file_count):
+        if layout == 'flat':
+            directory = assets_dir
+        elif layout == 'deep':
+            directory = os.path.join(assets_dir, *[
+                'directory%d' % random_.randrange(5) for _ in range(4)
+            ])
+        else:
+            raise ValueError('unknown layout: %r' % layout)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(
+            directory, 'file%d.%s' % (i, extensions[i % len(extensions)])
+        )
+        with open(filename, 'w') as file:
+            file.write('asset %d\n' % i)
+        filenames.append(filename)
+    return filenames
+
+
+def generate_tree_config(filepattern_format='regex', command='true'):
+    """
+    Returns the source of an `assets.cfg` file, with a rule executing
+    `command` for each of the extensions used by :func:`generate_tree`.
+    """
+    if filepattern_format == 'regex':
+        patterns = [r'.*\.css', r'.*\.js', '.*']
+    else:
+        patterns = ['*.css', '*.js', '*']
+    return ''.join('[%s]\n%s\n\n' % (pattern, command)
+                   for pattern in patterns)
+
+
+@contextmanager
+def synthetic_app(file_count, layout='flat', filepattern_format='regex'):
+    """
+    Creates an application with a synthetic asset tree in a temporary
+    directory, which is removed afterwards, and yields the application along
+    with the paths of the assets.
+    """
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, 'static'))
+        filenames = generate_tree(
+            os.path.join(root, 'assets'), file_count, layout
+        )
+        with open(os.path.join(root, 'assets.cfg'), 'w') as file:
+            file.write(generate_tree_config(filepattern_format))
+        app = Flask(__name__, static_folder=os.path.join(root, 'static'))
+        app.root_path = root
+        app.config['MAKESTATIC_FILEPATTERN_FORMAT'] = filepattern_format
+        yield app, filenames
+    finally:
+        shutil.rmtree(root)
+
+
+def get_cpu_time():
+    """
+    Returns the CPU time used by this process in seconds.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def bench_parser(rule_counts=(1000, 10000),
+                 filepattern_formats=('regex', 'globbing')):
+    """
+    Measures the time it takes to parse synthetic configurations and the
+    time it takes to create the matcher from the parsed rules.
+    """
+    results = []
+    for filepattern_format in filepattern_formats:
+        for rule_count in rule_counts:
+            source = generate_config(rule_count, filepattern_format)
+            def parse():
+                parser = _ConfigParser(StringIO(source), filepattern_format)
+                return parser.parse_rules()
+            rules = parse()
+            parser = _ConfigParser(StringIO(''), filepattern_format)
+            def create_matcher():
+                # Make sure the regular expressions are actually compiled.
+                re.purge()
+                parser.create_get_rule(rules)
+            results.append({
+                'format': filepattern_format,
+                'rules': rule_count,
+                'parse': timeit(parse),
+                'matcher': timeit(create_matcher)
+            })
+    return results
+
+
+def bench_matcher(rule_counts=(10, 100, 1000), file_count=10000):
+    """
+    Compares the throughput of matching filenames against glob rules, using
+    the combined regular expressions of the globbing matcher and using a
+    linear scan calling :func:`fnmatch.fnmatch` for each rule.
+    """
+    results = []
+    for rule_count in rule_counts:
+        patterns = generate_glob_rules(rule_count)
+        filenames = generate_filenames(file_count, rule_count)
+        get_rule = _ConfigParser(
+            StringIO(create_config(patterns)), 'globbing'
+        ).parse()
+        def linear_scan():
+            for filename in filenames:
+                for pattern in patterns:
+                    if fnmatch(filename, pattern):
+                        break
+        def combined():
+            for filename in filenames:
+                get_rule(filename)
+        results.append({
+            'rules': rule_count,
+            'files': file_count,
+            'linear_scan': file_count / timeit(linear_scan, repeat=1),
+            'combined': file_count / timeit(combined)
+        })
+    return results
+
+
+def bench_startup(rule_count=10000, filepattern_format='globbing'):
+    """
+    Measures the time it takes to initialize an application with a large
+    `assets.cfg`, parsing it, loading the parsed rules from the
+    `MAKESTATIC_CONFIG_CACHE` and reusing the rules of another application
+    within the same process.
+    """
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, 'assets'))
+        os.mkdir(os.path.join(root, 'static'))
+        with open(os.path.join(root, 'assets.cfg'), 'w') as file:
+            file.write(generate_config(rule_count, filepattern_format))
+        def init(cache=None):
+            app = Flask(__name__, static_folder=os.path.join(root, 'static'))
+            app.root_path = root
+            app.config['MAKESTATIC_FILEPATTERN_FORMAT'] = filepattern_format
+            app.config['MAKESTATIC_CONFIG_CACHE'] = cache
+            MakeStatic(app)
+        def parse():
+            makestatic._matchers.clear()
+            re.purge()
+            init()
+        cache = os.path.join(root, 'cache')
+        init(cache)
+        def load():
+            makestatic._matchers.clear()
+            re.purge()
+            init(cache)
+        return {
+            'rules': rule_count,
+            'parse': timeit(parse),
+            'cache': timeit(load),
+            'reuse': timeit(init)
+        }
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_commands(command_count=200):
+    """
+    Compares the time it takes to execute ``cp {asset} {static}`` in a shell
+    with executing it directly and with the ``@copy`` action.
+    """
+    root = tempfile.mkdtemp()
+    try:
+        substitutions = {
+            'asset': os.path.join(root, 'asset'),
+            'static': os.path.join(root, 'static')
+        }
+        with open(substitutions['asset'], 'w') as asset:
+            asset.write('asset')
+        template = _CommandTemplate('cp {asset} {static}')
+        def shell():
+            for _ in range(command_count):
+                run_command(template.template.format(**substitutions))
+        def direct():
+            for _ in range(command_count):
+                run_command(template.format(**substitutions))
+        action = _CommandTemplate('@copy {asset} {static}')
+        def builtin():
+            for _ in range(command_count):
+                action.run(**substitutions)
+        return {
+            'commands': command_count,
+            'shell': command_count / timeit(shell),
+            'direct': command_count / timeit(direct),
+            'action': command_count / timeit(builtin)
+        }
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_signals(send_count=200000, listener_count=2):
+    """
+    Measures how many times per second a :class:`Signal` can be sent to
+    `listener_count` listeners that are connected inline, strongly and
+    weakly.
+    """
+    class Listener(object):
+        def __call__(self, item):
+            pass
+    listeners = [Listener() for _ in range(listener_count)]
+    results = []
+    for weak in [False, True]:
+        signal = Signal()
+        for listener in listeners:
+            signal.connect(listener, weak=weak)
+        def send():
+            for i in range(send_count):
+                signal.send(i)
+        results.append({
+            'listeners': listener_count,
+            'weak': weak,
+            'sends': send_count / timeit(send)
+        })
+    return results
+
+
+def bench_compile(file_counts=(1000, 10000), layouts=('flat', 'deep'),
+                  filepattern_formats=('regex', 'globbing'), jobs=None):
+    """
+    Measures the time it takes to :meth:`MakeStatic.compile` synthetic asset
+    trees, using `jobs` threads, with ``true`` as the command of every rule,
+    so that the overhead of Flask-MakeStatic dominates.
+    """
+    if jobs is None:
+        jobs = cpu_count()
+    results = []
+    for file_count in file_counts:
+        for layout in layouts:
+            for filepattern_format in filepattern_formats:
+                with synthetic_app(
+                    file_count, layout, filepattern_format
+                ) as (app, _):
+                    make_static = MakeStatic(app)
+                    with app.app_context():
+                        duration = timeit(
+                            lambda: make_static.compile(jobs=jobs), repeat=1
+                        )
+                results.append({
+                    'files': file_count,
+                    'layout': layout,
+                    'format': filepattern_format,
+                    'jobs': jobs,
+                    'compile': duration
+                })
+    return results
+
+
+def measure_watcher(watcher, filenames, samples=9, idle=1.0, sleep=0.1,
+                    timeout=30.0):
+    """
+    Measures the CPU time `watcher` uses per second while nothing changes
+    over `idle` seconds, and the median time it takes to detect the
+    modification of one of `filenames`, over `samples` modifications.
+    """
+    detected = []
+    event = threading.Event()
+    @watcher.file_modified.connect
+    def file_modified(path):
+        detected.append((path, time.time()))
+        event.set()
+    watcher.watch(sleep=sleep)
+    try:
+        # Give the watcher the time to settle.
+        time.sleep(sleep * 2)
+        start = get_cpu_time()
+        time.sleep(idle)
+        idle_cpu = (get_cpu_time() - start) / idle
+        latencies = []
+        random_ = random.Random(0)
+        for i in range(samples):
+            filename = random_.choice(filenames)
+            del detected[:]
+            event.clear()
+            start = time.time()
+            with open(filename, 'a') as file:
+                file.write('modification %d\n' % i)
+            while True:
+                if not event.wait(timeout) and not detected:
+                    raise RuntimeError(
+                        'modification of %s not detected' % filename
+                    )
+                times = [when for path, when in detected if path == filename]
+                if times:
+                    latencies.append(times[0] - start)
+                    break
+                event.clear()
+        latencies.sort()
+        return idle_cpu, latencies[len(latencies) // 2]
+    finally:
+        watcher.stop()
+
+
+def bench_watch(file_counts=(1000, 10000), layouts=('flat', 'deep'),
+                backends=('polling', 'inotify')):
+    """
+    Measures the time it takes the watcher backends to detect a modified file
+    in synthetic asset trees and the CPU time they use, while nothing
+    changes. Backends that are not available are skipped.
+    """
+    results = []
+    for file_count in file_counts:
+        for layout in layouts:
+            with synthetic_app(file_count, layout) as (app, filenames):
+                for backend in backends:
+                    try:
+                        watcher = create_watcher(backend)
+                    except OSError:
+                        continue
+                    start = time.time()
+                    watcher.add_directory(os.path.join(app.root_path,
+                                                       'assets'))
+                    setup = time.time() - start
+                    idle_cpu, latency = measure_watcher(watcher, filenames)
+                    results.append({
+                        'files': file_count,
+                        'layout': layout,
+                        'backend': backend,
+                        'setup': setup,
+                        'idle_cpu': idle_cpu,
+                        'latency': latency
+                    })
+    return results
+
+
+def print_parser(results):
+    print('parsing time in seconds')
+    print('%8s %8s %10s %10s' % ('format', 'rules', 'parse', 'matcher'))
+    for result in results:
+        print('%(format)8s %(rules)8d %(parse)10.4f %(matcher)10.4f' % result)
+
+
+def print_matcher(results):
+    print('matcher throughput in files per second')
+    print('%8s %14s %14s' % ('rules', 'linear scan', 'combined'))
+    for result in results:
+        print('%(rules)8d %(linear_scan)14.0f %(combined)14.0f' % result)
+
+
+def print_startup(results):
+    print('application startup in seconds')
+    print('%8s %10s %10s %10s' % ('rules', 'parse', 'cache', 'reuse'))
+    for result in results:
+        print('%(rules)8d %(parse)10.4f %(cache)10.4f %(reuse)10.4f' % result)
+
+
+def print_commands(results):
+    print('commands executed per second')
+    print('%8s %10s %10s %10s' % ('commands', 'shell', 'direct', 'action'))
+    for result in results:
+        print('%(commands)8d %(shell)10.0f %(direct)10.0f %(action)10.0f' %
+              result)
+
+
+def print_signals(results):
+    print('signals sent per second')
+    print('%10s %6s %12s' % ('listeners', 'weak', 'sends'))
+    for result in results:
+        print('%(listeners)10d %(weak)6s %(sends)12.0f' % result)
+
+
+def print_compile(results):
+    print('compile time in seconds')
+    print('%8s %8s %8s %6s %10s' % ('files', 'layout', 'format', 'jobs',
+                                    'compile'))
+    for result in results:
+        print('%(files)8d %(layout)8s %(format)8s %(jobs)6d %(compile)10.3f' %
+              result)
+
+
+def print_watch(results):
+    print('watcher setup and latency in seconds, idle CPU time per second')
+    print('%8s %8s %8s %10s %10s %10s' % (
+        'files', 'layout', 'backend', 'setup', 'latency', 'idle cpu'
+    ))
+    for result in results:
+        print('%(files)8d %(layout)8s %(backend)8s %(setup)10.4f '
+              '%(latency)10.4f %(idle_cpu)10.4f' % result)
+
+
+#: The benchmarks in the order in which they are run, along with the
+#: functions printing their results. Benchmarks working on synthetic asset
+#: trees are called with the `file_counts` to use.
+benchmarks = [
+    ('parser', bench_parser, print_parser, False),
+    ('matcher', bench_matcher, print_matcher, False),
+    ('startup', lambda: [bench_startup()], print_startup, False),
+    ('commands', lambda: [bench_commands()], print_commands, False),
+    ('signals', bench_signals, print_signals, False),
+    ('compile', bench_compile, print_compile, True),
+    ('watch', bench_watch, print_watch, True)
+]
+
+#: Metrics for which larger values are better, all others are durations.
+throughput_metrics = frozenset([
+    'linear_scan', 'combined', 'shell', 'direct', 'action', 'sends'
+])
+
+
+def run_benchmarks(names, file_counts):
+    results = {}
+    for name, function, print_results, uses_trees in benchmarks:
+        if name not in names:
+            continue
+        if uses_trees:
+            results[name] = function(file_counts=file_counts)
+        else:
+            results[name] = function()
+        print_results(results[name])
+        print('')
+    return results
+
+
+def split_result(result):
+    """
+    Splits a `result` into a key, made up of the parameters of the
+    measurement, and a dictionary of the measured metrics, which are the
+    floats.
+    """
+    key = tuple(sorted(
+        (name, value) for name, value in result.items()
+        if not isinstance(value, float)
+    ))
+    metrics = dict(
+        (name, value) for name, value in result.items()
+        if isinstance(value, float)
+    )
+    return key, metrics
+
+
+def compare(baseline, results, threshold=0.1):
+    """
+    Prints the change of each metric in `results` relative to the same metric
+    in `baseline` and returns the number of metrics that have become worse by
+    more than `threshold`.
+    """
+    regressions = 0
+    print('changes relative to the baseline')
+    print('%-10s %-40s %-12s %12s %12s %8s' % (
+        'benchmark', 'parameters', 'metric', 'baseline', 'current', 'change'
+    ))
+    for name, _, _, _ in benchmarks:
+        previous = dict(map(split_result, baseline.get(name, [])))
+        for result in results.get(name, []):
+            key, metrics = split_result(result)
+            if key not in previous:
+                continue
+            parameters = ' '.join('%s=%s' % item for item in key)
+            for metric, value in sorted(metrics.items()):
+                old = previous[key].get(metric)
+                if not old:
+                    continue
+                change = (value - old) / old
+                if metric in throughput_metrics:
+                    worse = change < -threshold
+                else:
+                    worse = change > threshold
+                regressions += worse
+                print('%-10s %-40s %-12s %12.4f %12.4f %+7.1f%%%s' % (
+                    name, parameters, metric, old, value, change * 100,
+                    ' !' if worse else ''
+                ))
+    return regressions
+
+
+def main(argv=sys.argv[1:]):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '--only', default=','.join(name for name, _, _, _ in benchmarks),
+        help='comma separated names of the benchmarks to run'
+    )
+    parser.add_option(
+        '--files', default='1000,10000',
+        help='comma separated sizes of the synthetic asset trees'
+    )
+    parser.add_option(
+        '--json', metavar='FILE', help='write the results to FILE as JSON'
+    )
+    parser.add_option(
+        '--compare', metavar='FILE',
+        help='compare the results with those previously written to FILE'
+    )
+    parser.add_option(
+        '--threshold', type='float', default=0.1,
+        help='relative change considered a regression [default: %default]'
+    )
+    options, _ = parser.parse_args(argv)
+    names = options.only.split(',')
+    unknown = set(names) - set(name for name, _, _, _ in benchmarks)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+    file_counts = [int(count) for count in options.files.split(',')]
+    results = run_benchmarks(names, file_counts)
+    if options.json is not None:
+        with open(options.json, 'w') as file:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': cpu_count(),
+                'time': time.time(),
+                'results': results
+            }, file, indent=2, sort_keys=True)
+    if options.compare is not None:
+        with open(options.compare) as file:
+            baseline = json.load(file)['results']
+        if compare(baseline, results, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
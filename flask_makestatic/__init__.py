@@ -8,142 +8,1806 @@
 """
 import os
 import re
+import sys
+import zlib
+import json
+import time
+import errno
+import shlex
+import shutil
+import signal
+import hashlib
+import tempfile
 import warnings
+import mimetypes
+import threading
 import subprocess
-from fnmatch import fnmatch
+from fnmatch import translate
+from contextlib import contextmanager
 from functools import wraps, partial
 from itertools import starmap, repeat, takewhile
+from collections import deque, namedtuple, OrderedDict
+from multiprocessing import cpu_count
 
-from flask import current_app, _app_ctx_stack
-from flask.ext.makestatic.watcher import ThreadedWatcher
+from flask import current_app, request, safe_join
+from flask.ext.makestatic._compat import PY2, iteritems, StringIO
+from flask.ext.makestatic.watcher import create_watcher, Debouncer, Signal
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 __version__ = '0.3.0-dev'
 __version_info__ = (0, 3, 0)
 
 
-_section_re = re.compile(r"\[(?P<file_re>[^\]]+)\]")
-_command_re = re.compile(r'\s*(?P<command>.*?)\s*$')
+_section_re = re.compile(r"\[(?P<file_re>[^\]]+)\]")
+_glob_magic_re = re.compile(r'[*?[\]]')
+_command_re = re.compile(r'\s*(?P<command>.*?)\s*$')
+_option_re = re.compile(r'\s*:(?P<name>[a-z-]+)(?:\s+(?P<value>.*?))?\s*$')
+
+#: Options that may be given within a rule, using ``:name value`` lines.
+_rule_options = frozenset(['outputs', 'scan', 'depfile', 'daemon'])
+
+#: Characters with a special meaning to the shell, apart from quotes.
+_shell_syntax_re = re.compile(r'[|&;<>()$`\\*?[\]~!\n]')
+
+#: Builtins and keywords of the shell, that cannot be executed directly.
+_shell_builtins = frozenset([
+    '.', ':', 'alias', 'case', 'cd', 'eval', 'exec', 'exit', 'export', 'for',
+    'if', 'read', 'set', 'shift', 'source', 'trap', 'ulimit', 'umask',
+    'unset', 'until', 'wait', 'while', '{'
+])
+
+#: Name of the build manifest within the static folder.
+_manifest_filename = '.makestatic-manifest.json'
+
+#: Name of the manifest of fingerprinted filenames within the static folder.
+_url_manifest_filename = '.makestatic-urls.json'
+
+#: Number of hexadecimal digits of the content hash in fingerprinted names.
+_fingerprint_length = 8
+
+#: Cache-Control header of responses with fingerprinted static files.
+_immutable_cache_control = 'public, max-age=31536000, immutable'
+
+#: Matchers by the hash of the configuration they have been created from and
+#: the filepattern format. Applications that are initialized before a server
+#: forks its workers, share the matchers with them.
+_matchers = {}
+
+
+def repeatfunc(func):
+    return starmap(func, repeat(()))
+
+
+def hash_file(filename):
+    file_hash = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for chunk in iter(partial(file.read, 64 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def write_atomically(filename, data):
+    fd, temporary_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename),
+        prefix='.' + os.path.basename(filename)
+    )
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.rename(temporary_filename, filename)
+    except:
+        os.remove(temporary_filename)
+        raise
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _Job(object):
+    """
+    Represents the compilation of an asset by a :class:`_CompileQueue`, which
+    may be cancelled while it is running.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self._process = None
+        self._lock = threading.Lock()
+
+    def attach(self, process):
+        with self._lock:
+            self._process = process
+            if self.cancelled:
+                self._kill()
+
+    def detach(self):
+        with self._lock:
+            self._process = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._process is not None:
+                self._kill()
+
+    def _kill(self):
+        _kill_process_group(self._process)
+
+
+#: The :class:`_Job` the current thread is working on, if any.
+_current = threading.local()
+
+
+def _split_command(command):
+    """
+    Returns the arguments of `command`, if it can be executed without a
+    shell, otherwise `None`.
+    """
+    if _shell_syntax_re.search(command) is not None:
+        return None
+    try:
+        arguments = shlex.split(command)
+    except ValueError:
+        return None
+    if not arguments or arguments[0] in _shell_builtins or \
+            '=' in arguments[0]:
+        return None
+    return arguments
+
+
+def _thread_time():
+    """
+    Returns the CPU time used by the current thread or `None`, if that
+    cannot be determined.
+    """
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+
+
+#: The ioctl request cloning a file on Linux, supported by btrfs and xfs.
+_FICLONE = 0x40049409
+
+#: Error numbers indicating that a way of copying is not supported for the
+#: given files, in which case we fall back to another one.
+_unsupported_copy_errnos = frozenset(
+    getattr(errno, name) for name in [
+        'EXDEV', 'ENOSYS', 'EINVAL', 'ENOTTY', 'EOPNOTSUPP', 'ENOTSUP'
+    ]
+    if hasattr(errno, name)
+)
+
+_copy_chunk_size = 1024 * 1024
+
+
+def _read_write(source_fd, destination_fd):
+    data = os.read(source_fd, _copy_chunk_size)
+    written = 0
+    while written < len(data):
+        written += os.write(destination_fd, data[written:])
+    return len(data)
+
+
+def _chunk_copiers():
+    if hasattr(os, 'copy_file_range'):
+        yield lambda source_fd, destination_fd: os.copy_file_range(
+            source_fd, destination_fd, _copy_chunk_size
+        )
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        yield lambda source_fd, destination_fd: os.sendfile(
+            destination_fd, source_fd, None, _copy_chunk_size
+        )
+    yield _read_write
+
+
+def _copy_data(source_fd, destination_fd):
+    """
+    Copies the content of `source_fd` to `destination_fd`, from and to their
+    current positions, without copying the data through userspace, if
+    possible.
+    """
+    for copy_chunk in _chunk_copiers():
+        copied = 0
+        try:
+            while True:
+                length = copy_chunk(source_fd, destination_fd)
+                if not length:
+                    return
+                copied += length
+        except EnvironmentError as error:
+            if copied or error.errno not in _unsupported_copy_errnos:
+                raise
+
+
+def _open_destination(filename, mode=0o666):
+    return os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+
+
+def _copy(source, destination):
+    """
+    The ``@copy`` action, copies the file `source` to `destination`, cloning
+    it if the filesystem supports it.
+    """
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        destination_fd = _open_destination(
+            destination, os.fstat(source_fd).st_mode & 0o777
+        )
+        try:
+            if fcntl is not None and sys.platform.startswith('linux'):
+                try:
+                    fcntl.ioctl(destination_fd, _FICLONE, source_fd)
+                    return
+                except EnvironmentError as error:
+                    if error.errno not in _unsupported_copy_errnos:
+                        raise
+            _copy_data(source_fd, destination_fd)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+
+
+def _mkdir(*directories):
+    """
+    The ``@mkdir`` action, creates the given `directories` along with any
+    missing parents, like ``mkdir -p``.
+    """
+    for directory in directories:
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST or not os.path.isdir(directory):
+                raise
+
+
+def _concat(*filenames):
+    """
+    The ``@concat`` action, writes the content of all but the last of the
+    given `filenames` to the last one.
+    """
+    sources, destination = filenames[:-1], filenames[-1]
+    destination_fd = _open_destination(destination)
+    try:
+        for source in sources:
+            source_fd = os.open(source, os.O_RDONLY)
+            try:
+                _copy_data(source_fd, destination_fd)
+            finally:
+                os.close(source_fd)
+    finally:
+        os.close(destination_fd)
+
+
+#: Actions that are performed in-process, by name and with the minimum and
+#: maximum number of arguments.
+_actions = {
+    'copy': (_copy, 2, 2),
+    'mkdir': (_mkdir, 1, None),
+    'concat': (_concat, 2, None)
+}
+
+
+class _CommandTemplate(object):
+    """
+    A command of a rule, that is split into arguments once, if it can be
+    executed without a shell, or a builtin action, if it starts with ``@``.
+
+    Raises :exc:`ValueError`, if the action is unknown or given the wrong
+    number of arguments.
+    """
+    def __init__(self, template):
+        self.template = template
+        self.action = None
+        if template.startswith('@'):
+            try:
+                arguments = shlex.split(template[1:])
+            except ValueError as error:
+                raise ValueError('invalid action: %s' % error)
+            if not arguments or arguments[0] not in _actions:
+                raise ValueError('unknown action %s' % template.split()[0])
+            self.action = arguments.pop(0)
+            _, minimum, maximum = _actions[self.action]
+            if len(arguments) < minimum or \
+                    maximum is not None and len(arguments) > maximum:
+                raise ValueError(
+                    'wrong number of arguments for @%s' % self.action
+                )
+            self.arguments = arguments
+        else:
+            self.arguments = _split_command(template)
+
+    @classmethod
+    def from_split(cls, template, action, arguments):
+        """
+        Returns the template of a command, that has already been split into
+        the `action` and `arguments` of another template, without splitting
+        it again.
+
+        Raises :exc:`ValueError`, if these cannot belong to a template.
+        """
+        if arguments is not None and not isinstance(arguments, list) or \
+                action is not None and (
+                    action not in _actions or arguments is None
+                ):
+            raise ValueError('invalid split command: %r' % template)
+        self = cls.__new__(cls)
+        self.template = template
+        self.action = action
+        self.arguments = arguments
+        return self
+
+    def format(self, **substitutions):
+        """
+        Returns the command with the given `substitutions`, as a list of
+        arguments or as a string, if it has to be executed in a shell.
+        """
+        if self.arguments is None:
+            return self.template.format(**substitutions)
+        return [
+            argument.format(**substitutions) for argument in self.arguments
+        ]
+
+    def run(self, **substitutions):
+        """
+        Performs the action or executes the command, with the given
+        `substitutions`, and returns the CPU time used in seconds or `None`.
+        """
+        if self.action is None:
+            return run_command(self.format(**substitutions))
+        start = _thread_time()
+        _actions[self.action][0](*self.format(**substitutions))
+        if start is not None:
+            return _thread_time() - start
+
+
+def _start_command(command, **kwargs):
+    shell = not isinstance(command, list)
+    try:
+        return subprocess.Popen(command, shell=shell, **kwargs)
+    except OSError as error:
+        if shell:
+            raise
+        # Fail like the shell would, if the program cannot be executed.
+        raise subprocess.CalledProcessError(
+            127 if error.errno == errno.ENOENT else 126, command
+        )
+
+
+def _wait(process):
+    """
+    Waits for `process` to terminate and returns its return code and the CPU
+    time it and its children used in seconds, or `None` if that cannot be
+    determined on this platform.
+    """
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    while True:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as error:
+            if error.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+
+def run_command(command):
+    """
+    Executes `command` and returns the CPU time it used in seconds or `None`,
+    if that cannot be determined. `command` is either a string, that is
+    executed in a shell, or a list of arguments, that is executed directly.
+
+    Raises a :exc:`subprocess.CalledProcessError`, if the command fails, with
+    the CPU time as :attr:`cpu_time`. If the current thread is working on a
+    :class:`_Job` that gets cancelled, the command is killed and
+    :exc:`_Cancelled` is raised.
+    """
+    job = getattr(_current, 'job', None)
+    if job is None:
+        returncode, cpu_time = _wait(_start_command(command))
+    else:
+        if job.cancelled:
+            raise _Cancelled()
+        # Run the command in a new process group, so that we can kill a shell
+        # along with everything it started.
+        process = _start_command(
+            command, preexec_fn=os.setsid if os.name == 'posix' else None
+        )
+        job.attach(process)
+        try:
+            returncode, cpu_time = _wait(process)
+        finally:
+            job.detach()
+        if job.cancelled:
+            raise _Cancelled()
+    if returncode:
+        error = subprocess.CalledProcessError(returncode, command)
+        error.cpu_time = cpu_time
+        raise error
+    return cpu_time
+
+
+def _kill_process_group(process):
+    try:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGTERM)
+        else:
+            process.terminate()
+    except OSError:
+        pass
+
+
+def _default_daemon_count():
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class _DaemonPool(object):
+    """
+    A pool of up to `size` instances of a compiler daemon, started using the
+    shell `command` as they are needed.
+
+    A daemon reads requests from its standard input and writes responses to
+    its standard output, both are JSON objects, one per line. A request
+    contains the substitutions of the asset to compile and the `commands` of
+    its rule, a response contains the `status`, which is ``0`` on success,
+    and optionally an `error` message.
+
+    A daemon that exits is replaced by a new one, when it is needed again.
+    """
+    def __init__(self, command, size):
+        self.command = command
+        self.size = max(size, 1)
+        self._idle = []
+        self._count = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _start(self):
+        return subprocess.Popen(
+            self.command, shell=True,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            preexec_fn=os.setsid if os.name == 'posix' else None
+        )
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                while self._idle:
+                    process = self._idle.pop()
+                    if process.poll() is None:
+                        return process
+                    # The daemon has crashed while it was idle.
+                    self._count -= 1
+                    self._stop(process)
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                self._condition.wait()
+        try:
+            return self._start()
+        except:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, process, healthy):
+        with self._condition:
+            if healthy and not self._closed and process.poll() is None:
+                self._idle.append(process)
+            else:
+                self._count -= 1
+                healthy = False
+            self._condition.notify()
+        if not healthy:
+            self._stop(process)
+
+    def _stop(self, process):
+        for pipe in [process.stdin, process.stdout]:
+            try:
+                pipe.close()
+            except EnvironmentError:
+                pass
+        if process.poll() is None:
+            _kill_process_group(process)
+        process.wait()
+
+    def run(self, request):
+        """
+        Sends `request` to an idle daemon and waits for the response. Raises a
+        :exc:`subprocess.CalledProcessError`, if the request fails or the
+        daemon exits. If the current thread is working on a :class:`_Job`
+        that gets cancelled, the daemon is killed and :exc:`_Cancelled` is
+        raised.
+        """
+        job = getattr(_current, 'job', None)
+        if job is not None and job.cancelled:
+            raise _Cancelled()
+        process = self._acquire()
+        healthy = False
+        if job is not None:
+            job.attach(process)
+        try:
+            try:
+                process.stdin.write(
+                    json.dumps(request).encode('utf-8') + b'\n'
+                )
+                process.stdin.flush()
+                line = process.stdout.readline()
+            except EnvironmentError:
+                line = b''
+            if job is not None and job.cancelled:
+                raise _Cancelled()
+            if not line:
+                raise subprocess.CalledProcessError(
+                    process.wait(), self.command
+                )
+            response = json.loads(line.decode('utf-8'))
+            healthy = True
+        finally:
+            if job is not None:
+                job.detach()
+            self._release(process, healthy)
+        if response.get('status', 0):
+            error = subprocess.CalledProcessError(
+                response['status'], self.command
+            )
+            error.output = response.get('error')
+            raise error
+
+    def close(self):
+        """
+        Stops all idle daemons, daemons that are busy are stopped once they
+        are done.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+        for process in idle:
+            self._stop(process)
+
+
+#: Replaces a file atomically, even if the destination exists on Windows.
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _publish(staging_dir, static_dir):
+    """
+    Moves every file within `staging_dir` to the corresponding location
+    within `static_dir`, replacing existing files atomically. Directories are
+    only created in `static_dir`, if files are moved into them.
+    """
+    for root, _, files in os.walk(staging_dir):
+        if not files:
+            continue
+        target_root = os.path.join(
+            static_dir, os.path.relpath(root, staging_dir)
+        )
+        if not os.path.isdir(target_root):
+            os.makedirs(target_root)
+        for file in files:
+            _replace(os.path.join(root, file), os.path.join(target_root, file))
+
+
+@contextmanager
+def _staged_outputs(static_dir, relative_filename):
+    """
+    Creates a staging directory within `static_dir` and yields it. If the
+    block succeeds, the files within the staging directory are published to
+    `static_dir`, in any case the staging directory is removed afterwards.
+
+    The directory corresponding to the directory of `relative_filename` is
+    created in advance.
+    """
+    if not os.path.isdir(static_dir):
+        os.makedirs(static_dir)
+    staging_dir = tempfile.mkdtemp(dir=static_dir, prefix='.makestatic-')
+    try:
+        directory = os.path.dirname(
+            os.path.join(staging_dir, relative_filename)
+        )
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        yield staging_dir
+        _publish(staging_dir, static_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _extension(path):
+    basename = os.path.basename(path)
+    if '.' in basename:
+        return basename[basename.rindex('.'):]
+    return ''
+
+
+def _directory(path):
+    return path.split('/', 1)[0] if '/' in path else None
+
+
+def _glob_directory(pattern):
+    """
+    Returns the top-level directory every filename matching the glob
+    `pattern` must be in, or `None` if it cannot be determined.
+    """
+    return _directory(_glob_magic_re.split(pattern)[0])
+
+
+def _glob_extension(pattern):
+    """
+    Returns the extension every filename matching the glob `pattern` must
+    have, or `None` if it cannot be determined.
+    """
+    literal_suffix = _glob_magic_re.split(pattern)[-1]
+    if '.' not in os.path.basename(literal_suffix):
+        return None
+    return _extension(literal_suffix)
+
+
+def _combine_globs(patterns):
+    """
+    Combines the given ``(index, pattern)`` pairs into regular expressions
+    and returns a function that returns the index of the first pattern
+    matching a filename, or `None`.
+    """
+    matchers = []
+    # Older versions of Python support no more than 100 named groups.
+    for offset in range(0, len(patterns), 99):
+        flags = ''
+        alternatives = []
+        for index, pattern in patterns[offset:offset + 99]:
+            regex = translate(pattern)
+            if regex.endswith('(?ms)'):
+                regex, flags = regex[:-5], '(?ms)'
+            alternatives.append('(?P<r%d>%s)' % (index, regex))
+        matchers.append(re.compile(flags + '|'.join(alternatives)).match)
+    def get_index(filename):
+        for matcher in matchers:
+            match = matcher(filename)
+            if match:
+                return int(match.lastgroup[1:])
+    return get_index
+
+
+def _load_cached_rules(filename):
+    """
+    Returns the rules stored in `filename` by :func:`_store_cached_rules` or
+    `None`, if they cannot be loaded.
+    """
+    if filename is None:
+        return None
+    try:
+        with open(filename, 'rb') as cache_file:
+            data = json.loads(cache_file.read().decode('utf-8'))
+        rules = []
+        for pattern, commands, options, split_commands in data:
+            if not isinstance(commands, list) or \
+                    not isinstance(options, dict) or \
+                    len(commands) != len(split_commands):
+                return None
+            # Splitting the commands again would take most of the time saved
+            # by not parsing.
+            rules.append(Rule(pattern, commands, options, [
+                _CommandTemplate.from_split(command, action, arguments)
+                for command, (action, arguments)
+                in zip(commands, split_commands)
+            ]))
+        return rules
+    except (EnvironmentError, ValueError, TypeError):
+        # The cache may be missing or corrupted, in which case we have to
+        # parse.
+        return None
+
+
+def _store_cached_rules(filename, rules):
+    # Only plain data is stored, so that loading a cache written by someone
+    # else cannot execute code and rules are always created by the current
+    # version of Rule.
+    data = [
+        [rule.pattern, rule.commands, rule.options, [
+            [template.action, template.arguments]
+            for template in rule.command_templates
+        ]]
+        for rule in rules
+    ]
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        write_atomically(filename, json.dumps(data).encode('utf-8'))
+    except EnvironmentError:
+        # The cache is an optimization, not being able to write it is no
+        # reason to fail.
+        pass
+
+
+def run_jobs(function, arguments, jobs=1, fail_fast=False, context=None):
+    """
+    Calls `function` with each of the given `arguments`, using up to `jobs`
+    threads, and returns a list of ``(argument, exception)`` tuples for every
+    call that raised an exception, in the order of `arguments`.
+
+    If `fail_fast` is `True` no calls with arguments following one for which a
+    call failed are started and only the first failure, in the order of
+    `arguments`, is returned. This is the failure calling `function`
+    sequentially would have stopped at, regardless of `jobs`.
+
+    `context` may be a callable returning a context manager, that is entered
+    by each thread for as long as it is working.
+    """
+    arguments = list(arguments)
+    pending = iter(enumerate(arguments))
+    failures = {}
+    lock = threading.Lock()
+    def work():
+        while True:
+            with lock:
+                try:
+                    index, argument = next(pending)
+                except StopIteration:
+                    return
+                # Arguments preceding a failed one are still called, one of
+                # them may fail as well and is then the first failure.
+                if fail_fast and failures and index > min(failures):
+                    return
+            try:
+                function(argument)
+            except Exception as error:
+                with lock:
+                    failures[index] = argument, error
+    def worker():
+        if context is None:
+            work()
+        else:
+            with context():
+                work()
+    if jobs <= 1 or len(arguments) <= 1:
+        worker()
+    else:
+        threads = [
+            threading.Thread(target=worker)
+            for _ in range(min(jobs, len(arguments)))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if fail_fast and failures:
+        return [failures[min(failures)]]
+    return [failures[index] for index in sorted(failures)]
+
+
+class _CompileQueue(object):
+    """
+    Calls `compile` for each submitted filename on up to `jobs` daemon
+    threads, in the order in which they were submitted.
+
+    A filename that is submitted while it is still queued is not queued
+    again. A filename that is submitted while it is being compiled cancels
+    the running compilation and is queued again. `on_error` is called with
+    the filename and the exception, if a compilation fails.
+    """
+    def __init__(self, compile, on_error, jobs=1, context=None):
+        self.compile = compile
+        self.on_error = on_error
+        self.context = context
+        self._pending = deque()
+        self._running = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        for _ in range(max(jobs, 1)):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, filename):
+        with self._condition:
+            if filename in self._running:
+                self._running[filename].cancel()
+            if filename not in self._pending:
+                self._pending.append(filename)
+                self._condition.notify()
+
+    def stop(self):
+        """
+        Cancels running compilations, waits for them to finish cleaning up
+        and stops the threads.
+        """
+        with self._condition:
+            self._stopped = True
+            for job in self._running.values():
+                job.cancel()
+            self._condition.notify_all()
+            # Don't wait for ourselves, if we are stopped by a compilation.
+            own_job = getattr(_current, 'job', None)
+            while any(job is not own_job for job in self._running.values()):
+                self._condition.wait()
+
+    def _next(self):
+        # Never compile the same file on two threads at the same time, a
+        # cancelled compilation may still be running.
+        for filename in self._pending:
+            if filename not in self._running:
+                self._pending.remove(filename)
+                return filename
+
+    def _worker(self):
+        if self.context is None:
+            self._work()
+        else:
+            with self.context():
+                self._work()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                filename = None
+                while not self._stopped:
+                    filename = self._next()
+                    if filename is not None:
+                        break
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                job = self._running[filename] = _Job()
+            _current.job = job
+            try:
+                self.compile(filename)
+            except _Cancelled:
+                pass
+            except Exception as error:
+                self.on_error(filename, error)
+            finally:
+                _current.job = None
+                with self._condition:
+                    del self._running[filename]
+                    self._condition.notify_all()
+
+
+class RuleMissing(Warning):
+    """
+    Warning that is emitted if a rule cannot be found.
+    """
+
+
+class CompilationError(Exception):
+    """
+    Raised by :meth:`MakeStatic.compile` if one or more assets could not be
+    compiled. :attr:`failures` is a list of ``(filename, exception)`` tuples,
+    one for each asset that failed, in the order in which the assets would
+    have been compiled sequentially, followed by static files that could not
+    be precompressed.
+
+    .. versionadded:: 0.3.0
+    """
+    def __init__(self, failures):
+        Exception.__init__(self, failures)
+        self.failures = failures
+
+    def __str__(self):
+        return 'failed to compile %d asset(s): %s' % (
+            len(self.failures),
+            ', '.join('%s (%s)' % failure for failure in self.failures)
+        )
+
+
+#: The time it took to execute a command for an `asset`, sent by
+#: :attr:`MakeStatic.command_executed`. The `cpu_time` is `None`, if it cannot
+#: be determined, the `returncode` is `None`, if the command failed without
+#: one.
+CommandTiming = namedtuple('CommandTiming', [
+    'asset', 'command', 'wall_time', 'cpu_time', 'returncode'
+])
+
+#: The time it took to compile an `asset` using the `rule` with the given
+#: pattern, sent by :attr:`MakeStatic.asset_compiled`. `output_size` is the
+#: size of the files produced in bytes, `error` is the exception that caused
+#: the compilation to fail or `None` and `commands` is a list of
+#: :class:`CommandTiming`\s.
+AssetTiming = namedtuple('AssetTiming', [
+    'asset', 'rule', 'wall_time', 'cpu_time', 'output_size', 'error',
+    'commands'
+])
+
+
+def _sum_cpu_times(timings):
+    cpu_times = [
+        timing.cpu_time for timing in timings if timing.cpu_time is not None
+    ]
+    return sum(cpu_times) if cpu_times else None
+
+
+def _get_output_size(outputs):
+    size = 0
+    for output in outputs:
+        try:
+            size += os.path.getsize(output)
+        except EnvironmentError:
+            pass
+    return size
+
+
+class _Profile(object):
+    """
+    Collects :class:`AssetTiming`\s and writes a report ranking rules and
+    assets by the time it took to compile them. Paths are made relative to
+    `root_path`.
+    """
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.timings = []
+        self._lock = threading.Lock()
+
+    def add(self, timing):
+        with self._lock:
+            self.timings.append(timing)
+
+    def report(self):
+        with self._lock:
+            timings = sorted(self.timings, key=lambda timing: -timing.wall_time)
+        rules = OrderedDict()
+        for timing in timings:
+            rule = rules.setdefault(timing.rule, {
+                'rule': timing.rule, 'assets': 0, 'wall_time': 0.0,
+                'cpu_time': 0.0
+            })
+            rule['assets'] += 1
+            rule['wall_time'] += timing.wall_time
+            rule['cpu_time'] += timing.cpu_time or 0.0
+        return {
+            'wall_time': sum(timing.wall_time for timing in timings),
+            'cpu_time': _sum_cpu_times(timings) or 0.0,
+            'rules': sorted(
+                rules.values(), key=lambda rule: -rule['wall_time']
+            ),
+            'assets': [{
+                'asset': os.path.relpath(timing.asset, self.root_path),
+                'rule': timing.rule,
+                'wall_time': timing.wall_time,
+                'cpu_time': timing.cpu_time,
+                'output_size': timing.output_size,
+                'error': None if timing.error is None else str(timing.error),
+                'commands': [{
+                    'command': command.command,
+                    'wall_time': command.wall_time,
+                    'cpu_time': command.cpu_time,
+                    'returncode': command.returncode
+                } for command in timing.commands]
+            } for timing in timings]
+        }
+
+    def summary(self, report, limit=10):
+        lines = [
+            'compiled %d asset(s) in %.3fs, using %.3fs of CPU time' % (
+                len(report['assets']), report['wall_time'],
+                report['cpu_time']
+            ),
+            '',
+            '%10s %10s %8s  %s' % ('wall', 'cpu', 'assets', 'rule')
+        ]
+        for rule in report['rules'][:limit]:
+            lines.append('%9.3fs %9.3fs %8d  %s' % (
+                rule['wall_time'], rule['cpu_time'], rule['assets'],
+                rule['rule']
+            ))
+        lines.extend(['', '%10s %10s %10s  %s' % (
+            'wall', 'cpu', 'size', 'asset'
+        )])
+        for asset in report['assets'][:limit]:
+            lines.append('%9.3fs %9.3fs %10d  %s%s' % (
+                asset['wall_time'], asset['cpu_time'] or 0.0,
+                asset['output_size'], asset['asset'],
+                '' if asset['error'] is None else ' (failed)'
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, filename):
+        """
+        Writes the report as JSON to `filename` and the summary to a file
+        with the same name and the extension ``.txt``.
+        """
+        report = self.report()
+        write_atomically(filename, json.dumps(
+            report, indent=2, sort_keys=True
+        ).encode('utf-8'))
+        write_atomically(
+            os.path.splitext(filename)[0] + '.txt',
+            self.summary(report).encode('utf-8')
+        )
+
+
+class ParsingError(Exception):
+    def __init__(self, message, line, lineno):
+        Exception.__init__(self, message, line, lineno)
+        self.message = message
+        self.line = line
+        self.lineno = lineno
+
+
+class Rule(object):
+    """
+    A rule from `assets.cfg`, consisting of the filename `pattern` of the
+    section, the `commands` executed for matching assets and a dictionary of
+    `options`.
+
+    .. versionadded:: 0.3.0
+    """
+    def __init__(self, pattern, commands, options=None,
+                 command_templates=None):
+        self.pattern = pattern
+        self.commands = commands
+        if command_templates is None:
+            command_templates = [
+                _CommandTemplate(command) for command in commands
+            ]
+        self.command_templates = command_templates
+        self.options = {} if options is None else options
+
+    @property
+    def digest(self):
+        """
+        A hash of the commands and options of the rule.
+        """
+        return hashlib.sha1(json.dumps(
+            [self.commands, sorted(self.options.items())]
+        ).encode('utf-8')).hexdigest()
+
+    @property
+    def outputs(self):
+        """
+        The templates of the files the rule produces, as declared with the
+        ``:outputs`` option.
+        """
+        return self.options.get('outputs', '').split()
+
+    @property
+    def scanner(self):
+        """
+        The compiled regular expression given with the ``:scan`` option or
+        `None`.
+        """
+        if 'scan' in self.options:
+            return re.compile(self.options['scan'], re.MULTILINE)
+
+    @property
+    def depfile(self):
+        """
+        The template of the depfile given with the ``:depfile`` option or
+        `None`.
+        """
+        return self.options.get('depfile')
+
+    @property
+    def daemon(self):
+        """
+        The template of the command starting the compiler daemon given with
+        the ``:daemon`` option or `None`.
+        """
+        return self.options.get('daemon')
+
+    def __repr__(self):
+        return '%s(%r, %r, %r)' % (
+            self.__class__.__name__, self.pattern, self.commands, self.options
+        )
+
+
+class _ConfigParser(object):
+    def __init__(self, file, filepattern_format):
+        self.file = file
+        self.filepattern_format = filepattern_format
+        self.lines = self.stripped_comments(enumerate(file, start=1))
+        self.lookahead = None
+
+    def stripped_comments(self, lines):
+        for lineno, line in lines:
+            if '#' in line:
+                comment_start = line.index('#')
+                line = line[:comment_start].rstrip()
+                if not line:
+                    continue
+            elif not line.strip():
+                continue
+            yield lineno, line
+
+    def next_line(self):
+        if self.lookahead is not None:
+            line, self.lookahead = self.lookahead, None
+            return line
+        return next(self.lines)
+
+    def push_back(self, line):
+        self.lookahead = line
+
+    def parse_rule(self):
+        try:
+            lineno, line = self.next_line()
+        except StopIteration:
+            return
+        match = _section_re.match(line)
+        if match is None:
+            raise ParsingError('expected new rule', line, lineno)
+        regex = match.group('file_re')
+        commands = []
+        options = {}
+        while True:
+            try:
+                lineno, line = self.next_line()
+            except StopIteration:
+                break
+            if _section_re.match(line):
+                self.push_back((lineno, line))
+                break
+            option = _option_re.match(line)
+            if option is None:
+                command = line.strip()
+                if command.startswith('@'):
+                    try:
+                        _CommandTemplate(command)
+                    except ValueError as error:
+                        raise ParsingError(str(error), line, lineno)
+                commands.append(command)
+            elif option.group('name') in _rule_options:
+                options[option.group('name')] = option.group('value') or ''
+                if option.group('name') == 'scan':
+                    try:
+                        re.compile(options['scan'])
+                    except re.error as error:
+                        raise ParsingError(
+                            'invalid regular expression: %s' % error,
+                            line, lineno
+                        )
+            else:
+                raise ParsingError(
+                    'unknown option %s' % option.group('name'), line, lineno
+                )
+        return Rule(regex, commands, options)
+
+    def parse_rules(self):
+        return list(takewhile(lambda rule: rule is not None,
+                              repeatfunc(self.parse_rule)))
+
+    def parse(self):
+        return self.create_get_rule(self.parse_rules())
+
+    def create_get_rule(self, rules):
+        if self.filepattern_format == 'regex':
+            return self._create_get_rule_regex(rules)
+        elif self.filepattern_format == 'globbing':
+            return self._create_get_rule_globbing(rules)
+        raise NotImplementedError(self.filepattern_format)
+
+    def _create_get_rule_regex(self, rules):
+        file_regex = [rule.pattern for rule in rules]
+        matcher = re.compile(
+            '^%s$' % '|'.join(
+                '(%s)' % filename_description
+                for filename_description in file_regex
+            )
+        ).match
+        def get_rule(filename):
+            match = matcher(filename)
+            if match:
+                return rules[match.lastindex - 1]
+        return get_rule
+
+    def _create_get_rule_globbing(self, rules):
+        # Each pattern is translated into a regular expression and those are
+        # combined, like the regular expressions are in the regex format.
+        # Additionally we index the patterns by the directory a matching
+        # filename must be in or the extension it must have, so that we only
+        # need to try the patterns that can possibly match.
+        generic = []
+        by_directory = {}
+        by_extension = {}
+        for index, rule in enumerate(rules):
+            pattern = os.path.normcase(rule.pattern)
+            directory = _glob_directory(pattern)
+            extension = _glob_extension(pattern)
+            if directory is not None:
+                by_directory.setdefault(directory, []).append((index, pattern))
+            elif extension is not None:
+                by_extension.setdefault(extension, []).append((index, pattern))
+            else:
+                generic.append((index, pattern))
+        matchers = {}
+        def get_matcher(directory, extension):
+            key = (
+                directory if directory in by_directory else None,
+                extension if extension in by_extension else None
+            )
+            try:
+                return matchers[key]
+            except KeyError:
+                matcher = matchers[key] = _combine_globs(sorted(
+                    generic + by_directory.get(key[0], []) +
+                    by_extension.get(key[1], [])
+                ))
+                return matcher
+        def get_rule(filename):
+            filename = os.path.normcase(filename)
+            index = get_matcher(
+                _directory(filename), _extension(filename)
+            )(filename)
+            if index is not None:
+                return rules[index]
+        return get_rule
+
+
+class _BuildManifest(object):
+    """
+    Keeps track of the content hash of each asset, the digest of the rule with
+    which it has been compiled and the outputs that were produced, in a JSON
+    file within the static folder.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            with open(filename, 'rb') as manifest_file:
+                self.records = json.loads(manifest_file.read().decode('utf-8'))
+        except (EnvironmentError, ValueError):
+            self.records = {}
+
+    def is_current(self, asset, asset_hash, rule, dependencies):
+        with self._lock:
+            record = self.records.get(asset)
+        if record is None:
+            return False
+        if record['asset'] != asset_hash or record['rule'] != rule.digest:
+            return False
+        if record.get('dependencies', {}) != dependencies:
+            return False
+        static_dir = os.path.dirname(self.filename)
+        return all(
+            os.path.exists(os.path.join(static_dir, output))
+            for output in record['outputs']
+        )
+
+    def record(self, asset, asset_hash, rule, outputs, dependencies):
+        static_dir = os.path.dirname(self.filename)
+        with self._lock:
+            self.records[asset] = {
+                'asset': asset_hash,
+                'rule': rule.digest,
+                'outputs': [
+                    os.path.relpath(output, static_dir) for output in outputs
+                ],
+                'dependencies': dependencies
+            }
+
+    def discard(self, asset):
+        with self._lock:
+            self.records.pop(asset, None)
+
+    def prune(self, assets):
+        assets = set(assets)
+        with self._lock:
+            for asset in list(self.records):
+                if asset not in assets:
+                    del self.records[asset]
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self.records, indent=2, sort_keys=True)
+        write_atomically(self.filename, data.encode('utf-8'))
+
+
+def _fingerprinted(filename, file_hash):
+    base, extension = os.path.splitext(filename)
+    return '%s.%s%s' % (base, file_hash[:_fingerprint_length], extension)
+
+
+def _create_fingerprinted_copy(static_dir, name):
+    """
+    Creates a fingerprinted copy of the file with the given `name` within
+    `static_dir`, unless it exists already, and returns the name of the
+    copy.
+    """
+    path = os.path.join(static_dir, *name.split('/'))
+    fingerprinted = _fingerprinted(name, hash_file(path))
+    target = os.path.join(static_dir, *fingerprinted.split('/'))
+    if not os.path.exists(target):
+        _copy(path, target)
+    return fingerprinted
+
+
+class _URLManifest(object):
+    """
+    Maps the names of the files within the static folder to the names of
+    copies, that contain a hash of their content, in a JSON file within the
+    static folder.
+
+    Fingerprinted copies of previous versions remain in the static folder,
+    so that pages referencing them continue to work. They are remembered in
+    the manifest, so that they are not fingerprinted themselves.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            with open(filename, 'rb') as manifest_file:
+                data = json.loads(manifest_file.read().decode('utf-8'))
+            self.urls = data['urls']
+            self.fingerprinted = set(data['fingerprinted'])
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            self.urls = {}
+            self.fingerprinted = set()
+
+    def update(self):
+        """
+        Creates a fingerprinted copy of every file in the static folder, that
+        does not have one yet, and maps the files to them. Files whose name
+        starts with a dot are ignored.
+        """
+        static_dir = os.path.dirname(self.filename)
+        with self._lock:
+            previously_fingerprinted = set(self.fingerprinted)
+        urls = {}
+        for root, directories, files in os.walk(static_dir):
+            directories[:] = [
+                directory for directory in directories
+                if not directory.startswith('.')
+            ]
+            for file in files:
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+                if file.startswith('.') or \
+                        name in previously_fingerprinted or \
+                        _is_precompressed(path):
+                    continue
+                urls[name] = _create_fingerprinted_copy(static_dir, name)
+        fingerprinted = set(
+            name for name in previously_fingerprinted
+            if os.path.exists(os.path.join(static_dir, *name.split('/')))
+        )
+        fingerprinted.update(urls.values())
+        with self._lock:
+            self.urls = urls
+            self.fingerprinted = fingerprinted
+
+    def update_files(self, filenames):
+        """
+        Creates fingerprinted copies of the files with the given `filenames`
+        within the static folder, which have just been compiled, maps the
+        files to them and returns the paths of the copies. Files that no
+        longer exist are no longer mapped.
+        """
+        static_dir = os.path.dirname(self.filename)
+        copies = []
+        for filename in filenames:
+            name = os.path.relpath(filename, static_dir).replace(os.sep, '/')
+            if not os.path.isfile(filename):
+                with self._lock:
+                    self.urls.pop(name, None)
+                continue
+            fingerprinted = _create_fingerprinted_copy(static_dir, name)
+            with self._lock:
+                self.urls[name] = fingerprinted
+                self.fingerprinted.add(fingerprinted)
+            copies.append(os.path.join(static_dir, *fingerprinted.split('/')))
+        return copies
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({
+                'urls': self.urls,
+                'fingerprinted': sorted(self.fingerprinted)
+            }, indent=2, sort_keys=True)
+        write_atomically(self.filename, data.encode('utf-8'))
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+#: Encodings in which files are precompressed, in the order of preference,
+#: with the extension of the precompressed file and the compression function.
+_precompressed_encodings = [('gzip', '.gz', _gzip)]
+if brotli is not None:
+    _precompressed_encodings.insert(0, ('br', '.br', brotli.compress))
+
+#: Extensions of files that are already compressed.
+_compressed_extensions = frozenset([
+    '.gz', '.br', '.zip', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff',
+    '.woff2'
+])
+
+
+def _is_precompressed(filename):
+    return any(
+        filename.endswith(extension) and
+        os.path.isfile(filename[:-len(extension)])
+        for _, extension, _ in _precompressed_encodings
+    )
+
+
+def _find_compressible(static_dir, min_size):
+    """
+    Returns the files within `static_dir` that are at least `min_size` bytes
+    large and not compressed already. Files whose name starts with a dot are
+    ignored.
+    """
+    filenames = []
+    for root, directories, files in os.walk(static_dir):
+        directories[:] = [
+            directory for directory in directories
+            if not directory.startswith('.')
+        ]
+        for file in files:
+            if file.startswith('.'):
+                continue
+            filename = os.path.join(root, file)
+            if _is_compressible(filename, min_size):
+                filenames.append(filename)
+    return filenames
+
+
+def _is_compressible(filename, min_size):
+    return (
+        _extension(filename).lower() not in _compressed_extensions and
+        os.path.getsize(filename) >= min_size
+    )
+
 
+def _precompress(filename):
+    """
+    Writes a compressed copy of `filename` next to it for each encoding,
+    unless an up to date copy exists.
+    """
+    mtime = os.stat(filename).st_mtime
+    data = None
+    for _, extension, compress in _precompressed_encodings:
+        try:
+            if os.stat(filename + extension).st_mtime >= mtime:
+                continue
+        except OSError:
+            pass
+        if data is None:
+            with open(filename, 'rb') as file:
+                data = file.read()
+        write_atomically(filename + extension, compress(data))
 
-def repeatfunc(func):
-    return starmap(func, repeat(()))
 
+def _update_precompressed(filename, min_size):
+    """
+    Brings the compressed copies of `filename` up to date or removes them, if
+    `filename` no longer exists or is too small to be compressed.
+    """
+    if os.path.isfile(filename) and _is_compressible(filename, min_size):
+        _precompress(filename)
+        return
+    for _, extension, _ in _precompressed_encodings:
+        try:
+            os.remove(filename + extension)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
 
-def unzip(zipped):
-    return map(list, zip(*zipped))
 
+def _is_static_endpoint(endpoint):
+    return endpoint == 'static' or endpoint.endswith('.static')
 
-def new_app_context(f_or_app, appctx=None):
-    if hasattr(f_or_app, 'app_context'):
-        return partial(new_app_context, appctx=f_or_app.app_context())
-    if appctx is None:
-        if _app_ctx_stack.top is None:
-            raise RuntimeError('This decorator can only be used at local '
-                               'scopes when an app context is on the stack. '
-                               'For instance within view functions.')
-        appctx = _app_ctx_stack.top.app.app_context()
-    @wraps(f_or_app)
-    def wrapper(*args, **kwargs):
-        with appctx:
-            return f_or_app(*args, **kwargs)
-    return wrapper
 
+def _get_static_folder(endpoint):
+    """
+    Returns the static folder served by the static `endpoint` of the current
+    application or one of its blueprints.
+    """
+    if endpoint == 'static':
+        return current_app.static_folder
+    return current_app.blueprints[endpoint[:-len('.static')]].static_folder
 
-class RuleMissing(Warning):
+
+def _serve_precompressed(view, endpoint):
     """
-    Warning that is emitted if a rule cannot be found.
+    Wraps the static `view` of `endpoint`, so that precompressed copies of
+    files are served, if the client accepts their encoding. Copies older than
+    the file itself are ignored.
     """
+    @wraps(view)
+    def wrapper(filename, **kwargs):
+        static_folder = _get_static_folder(endpoint)
+        try:
+            mtime = os.stat(safe_join(static_folder, filename)).st_mtime
+        except OSError:
+            return view(filename, **kwargs)
+        for encoding, extension, _ in _precompressed_encodings:
+            compressed = safe_join(static_folder, filename + extension)
+            try:
+                if os.stat(compressed).st_mtime < mtime:
+                    continue
+            except OSError:
+                continue
+            if request.accept_encodings[encoding] > 0:
+                response = view(filename + extension, **kwargs)
+                response.headers['Content-Encoding'] = encoding
+                response.headers['Content-Type'] = (
+                    mimetypes.guess_type(filename)[0] or
+                    'application/octet-stream'
+                )
+                break
+        else:
+            response = view(filename, **kwargs)
+        response.vary.add('Accept-Encoding')
+        return response
+    return wrapper
 
 
-class ParsingError(Exception):
-    def __init__(self, message, line, lineno):
-        Exception.__init__(self, message, line, lineno)
-        self.message = message
-        self.line = line
-        self.lineno = lineno
+def parse_depfile(filename):
+    """
+    Returns the prerequisites listed in a depfile, as written by ``gcc -MD``
+    and similar tools, or an empty list, if the depfile does not exist.
+    """
+    try:
+        with open(filename) as depfile:
+            content = depfile.read()
+    except EnvironmentError:
+        return []
+    dependencies = []
+    for rule in content.replace('\\\n', ' ').splitlines():
+        _, _, prerequisites = rule.partition(': ')
+        dependencies.extend(
+            dependency.replace('\\ ', ' ')
+            for dependency in re.split(r'(?<!\\)\s+', prerequisites.strip())
+            if dependency
+        )
+    return dependencies
 
 
-class _ConfigParser(object):
-    def __init__(self, file, filepattern_format):
-        self.file = file
-        self.filepattern_format = filepattern_format
-        self.lines = list(self.stripped_comments(enumerate(file, start=1)))
+def _resolve_import(name, directories, extension):
+    head, tail = os.path.split(name)
+    candidates = [name, name + extension]
+    # sass partials are imported without their leading underscore
+    candidates.extend(os.path.join(head, '_' + candidate)
+                      for candidate in [tail, tail + extension])
+    for directory in directories:
+        for candidate in candidates:
+            path = os.path.normpath(os.path.join(directory, candidate))
+            if os.path.isfile(path):
+                return path
 
-    def stripped_comments(self, lines):
-        for lineno, line in lines:
-            if '#' in line:
-                comment_start = line.index('#')
-                line = line[:comment_start].rstrip()
-                if not line:
-                    continue
-            elif not line.strip():
-                continue
-            yield lineno, line
 
-    def next_line(self):
-        return self.lines.pop(0)
+def scan_dependencies(filename, scanner, directories=()):
+    """
+    Returns the set of files, `filename` transitively depends on, according
+    to the `scanner` regular expression, whose first group (or the entire
+    match, if there is no group) matches the name of an imported file.
 
-    def parse_rule(self):
+    Names are resolved relative to the directory of the importing file and
+    then relative to each of the given `directories`. The extension of the
+    importing file and a leading underscore are added, if necessary.
+    """
+    extension = os.path.splitext(filename)[1]
+    dependencies = set()
+    pending = [filename]
+    while pending:
+        current = pending.pop()
         try:
-            lineno, line = self.next_line()
-        except IndexError:
-            return
-        match = _section_re.match(line)
-        if match is None:
-            raise ParsingError('expected new rule', line, lineno)
-        regex = match.group('file_re')
-        commands = []
-        insert = False
-        while True:
+            with open(current) as file:
+                content = file.read()
+        except EnvironmentError:
+            continue
+        search_path = [os.path.dirname(current)] + list(directories)
+        for match in scanner.finditer(content):
+            name = match.group(1) if scanner.groups else match.group(0)
+            path = _resolve_import(name, search_path, extension)
+            if path is not None and path not in dependencies:
+                dependencies.add(path)
+                pending.append(path)
+    dependencies.discard(filename)
+    return dependencies
+
+
+class _DependencyGraph(object):
+    """
+    Keeps track of the files each asset depends on and the reverse, the
+    assets depending on each file.
+    """
+    def __init__(self):
+        self.dependencies = {}
+        self.dependents = {}
+        self._lock = threading.Lock()
+
+    def update(self, asset, dependencies):
+        with self._lock:
+            for dependency in self.dependencies.pop(asset, ()):
+                self.dependents[dependency].discard(asset)
+                if not self.dependents[dependency]:
+                    del self.dependents[dependency]
+            if dependencies:
+                self.dependencies[asset] = frozenset(dependencies)
+                for dependency in dependencies:
+                    self.dependents.setdefault(dependency, set()).add(asset)
+
+    def is_dependency(self, path):
+        with self._lock:
+            return path in self.dependents
+
+    def affected(self, path):
+        """
+        Returns a sorted list of all assets that directly or indirectly
+        depend on `path`.
+        """
+        affected = set()
+        with self._lock:
+            pending = [path]
+            while pending:
+                for asset in self.dependents.get(pending.pop(), ()):
+                    if asset not in affected:
+                        affected.add(asset)
+                        pending.append(asset)
+        affected.discard(path)
+        return sorted(affected)
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class _LRUCache(object):
+    """
+    A thread-safe mapping, that holds at most `maxsize` items, discarding
+    the least recently used item if necessary.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
             try:
-                lineno, line = self.next_line()
-            except IndexError:
-                break
-            if _section_re.match(line):
-                insert = True
-                break
-            commands.append(line.strip())
-        if insert:
-            self.lines.insert(0, (lineno, line))
-        return regex, commands
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
 
-    def parse(self):
-        return self.create_get_commands(
-            list(takewhile(lambda rule: rule is not None,
-                           repeatfunc(self.parse_rule)))
-        )
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
 
-    def create_get_commands(self, rules):
-        if self.filepattern_format == 'regex':
-            return self._create_get_commands_regex(rules)
-        elif self.filepattern_format == 'globbing':
-            return self._create_get_commands_globbing(rules)
-        raise NotImplementedError(self.filepattern_format)
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
 
-    def _create_get_commands_regex(self, rules):
-        file_regex = []
-        commandsets = []
-        if rules:
-            file_regex, commandsets = unzip(rules)
-        matcher = re.compile(
-            '^%s$' % '|'.join(
-                '(%s)' % filename_description
-                for filename_description in file_regex
+    def info(self):
+        with self._lock:
+            return CacheInfo(
+                self.hits, self.misses, self.maxsize, len(self._items)
             )
-        ).match
-        def get_commands(filename):
-            match = matcher(filename)
-            if match:
-                return commandsets[match.lastindex - 1]
-        return get_commands
 
-    def _create_get_commands_globbing(self, rules):
-        def get_commands(filename):
-            for pattern, commands in rules:
-                if fnmatch(filename, pattern):
-                    return commands
-        return get_commands
+
+_missing = object()
+
+
+class _MakeStaticState(object):
+    """
+    The state of an asset tree, consisting of the `assets` directory and
+    `assets.cfg` within `root_path` and the `static_folder` the assets are
+    compiled to. The tree of an application has the `name` `None`, those of
+    its blueprints have the name of the blueprint and are kept in the
+    :attr:`blueprints` of the application's tree.
+    """
+    def __init__(self, matcher, static_folder, rule_cache_size=1024,
+                 root_path=None, name=None):
+        # The matcher and the cache of its results are replaced together, so
+        # that a reload cannot leave rules of the old matcher in the cache.
+        self._rules = matcher, _LRUCache(rule_cache_size)
+        self.static_folder = static_folder
+        self.root_path = root_path
+        self.name = name
+        self.blueprints = {}
+        self.dependencies = _DependencyGraph()
+        self._manifest = None
+        self.url_manifest = None
+        self._daemon_pools = {}
+        self._asset_locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def manifest(self):
+        with self._lock:
+            if self._manifest is None:
+                return self.load_manifest()
+            return self._manifest
+
+    @property
+    def matcher(self):
+        return self._rules[0]
+
+    @property
+    def rule_cache(self):
+        return self._rules[1]
+
+    def get_rule(self, filename):
+        matcher, rule_cache = self._rules
+        rule = rule_cache.get(filename, _missing)
+        if rule is _missing:
+            rule = matcher(filename)
+            rule_cache.set(filename, rule)
+        return rule
+
+    def set_matcher(self, matcher):
+        self._rules = matcher, _LRUCache(self.rule_cache.maxsize)
+
+    @property
+    def assets_folder(self):
+        return os.path.join(self.root_path, 'assets')
+
+    @property
+    def config_filename(self):
+        return os.path.join(self.root_path, 'assets.cfg')
+
+    def describe(self, filename):
+        """
+        Returns the name of the asset `filename` for messages.
+        """
+        relative_filename = os.path.relpath(filename, self.assets_folder)
+        if self.name is None:
+            return relative_filename
+        return '%s (%s)' % (relative_filename, self.name)
+
+    def get_asset_lock(self, filename):
+        with self._lock:
+            lock = self._asset_locks.get(filename)
+            if lock is None:
+                lock = self._asset_locks[filename] = threading.Lock()
+            return lock
+
+    def get_daemon_pool(self, command, size):
+        with self._lock:
+            pool = self._daemon_pools.get(command)
+            if pool is None:
+                pool = self._daemon_pools[command] = _DaemonPool(
+                    command, size
+                )
+            return pool
+
+    def close_daemon_pools(self):
+        with self._lock:
+            pools, self._daemon_pools = self._daemon_pools, {}
+        for pool in pools.values():
+            pool.close()
+
+    def load_url_manifest(self):
+        self.url_manifest = _URLManifest(
+            os.path.join(self.static_folder, _url_manifest_filename)
+        )
+        return self.url_manifest
+
+    def load_manifest(self):
+        manifest = _BuildManifest(
+            os.path.join(self.static_folder, _manifest_filename)
+        )
+        self._manifest = manifest
+        return manifest
 
 
 class MakeStatic(object):
@@ -167,6 +1831,16 @@ class MakeStatic(object):
     """
     def __init__(self, app=None):
         self.app = app
+        #: A :class:`Signal` sent with a :class:`CommandTiming`, whenever a
+        #: command has been executed.
+        #:
+        #: .. versionadded:: 0.3.0
+        self.command_executed = Signal()
+        #: A :class:`Signal` sent with an :class:`AssetTiming`, whenever an
+        #: asset has been compiled or failed to compile.
+        #:
+        #: .. versionadded:: 0.3.0
+        self.asset_compiled = Signal()
         if app is not None:
             self.init_app(app)
 
@@ -186,23 +1860,267 @@ class MakeStatic(object):
 
         .. versionadded:: 0.3.0
         """
-        with app.open_resource('assets.cfg', 'r') as config_file:
-            app.extensions['MakeStatic'] = _ConfigParser(
-                config_file,
-                app.config.setdefault('MAKESTATIC_FILEPATTERN_FORMAT', 'regex')
-            ).parse()
+        app.config.setdefault('MAKESTATIC_FILEPATTERN_FORMAT', 'regex')
+        app.extensions['MakeStatic'] = _MakeStaticState(
+            self._parse_config(app, app.root_path),
+            app.static_folder,
+            app.config.setdefault('MAKESTATIC_RULE_CACHE_SIZE', 1024),
+            app.root_path
+        )
+        app.config.setdefault('MAKESTATIC_JOBS', 1)
+        app.config.setdefault('MAKESTATIC_INCREMENTAL', False)
+        app.config.setdefault('MAKESTATIC_WATCHER', 'auto')
+        app.config.setdefault('MAKESTATIC_WATCH_DELAY', 0.05)
+        app.config.setdefault('MAKESTATIC_WATCH_BUDGET', None)
+        app.config.setdefault('MAKESTATIC_DAEMONS', _default_daemon_count())
+        app.config.setdefault('MAKESTATIC_ATOMIC_WRITES', True)
+        app.config.setdefault('MAKESTATIC_FINGERPRINT', False)
+        if app.config['MAKESTATIC_FINGERPRINT']:
+            app.extensions['MakeStatic'].load_url_manifest()
+        app.url_defaults(self._url_defaults)
+        app.after_request(self._add_cache_control)
+        app.config.setdefault('MAKESTATIC_PRECOMPRESS', False)
+        app.config.setdefault('MAKESTATIC_PRECOMPRESS_MIN_SIZE', 1024)
+        app.config.setdefault('MAKESTATIC_PROFILE', None)
+        app.config.setdefault('MAKESTATIC_LAZY', False)
+        if app.config['MAKESTATIC_PRECOMPRESS'] or \
+                app.config['MAKESTATIC_LAZY']:
+            self._wrap_static_views(app)
+            # Blueprints are usually registered after the extension has been
+            # initialized.
+            app.before_first_request(partial(self._wrap_static_views, app))
+
+    def _wrap_static_views(self, app):
+        """
+        Wraps the views serving the static folders of the application and its
+        blueprints, that have not been wrapped already, to serve precompressed
+        files and compile assets lazily, as configured.
+        """
+        for endpoint, view in list(app.view_functions.items()):
+            if not _is_static_endpoint(endpoint) or \
+                    getattr(view, 'makestatic_wrapped', False):
+                continue
+            if app.config['MAKESTATIC_PRECOMPRESS']:
+                view = _serve_precompressed(view, endpoint)
+            if app.config['MAKESTATIC_LAZY']:
+                view = self._serve_lazily(view, endpoint)
+            view.makestatic_wrapped = True
+            app.view_functions[endpoint] = view
+
+    def _parse_config(self, app, root_path):
+        start = time.time()
+        config_filename = os.path.join(root_path, 'assets.cfg')
+        with open(config_filename, 'rb') as config_file:
+            source = config_file.read()
+        filepattern_format = app.config['MAKESTATIC_FILEPATTERN_FORMAT']
+        key = hashlib.sha1(source).hexdigest(), filepattern_format
+        matcher = _matchers.get(key)
+        if matcher is None:
+            parser = _ConfigParser(
+                StringIO(source if PY2 else source.decode('utf-8')),
+                filepattern_format
+            )
+            cache_filename = None
+            if app.config.get('MAKESTATIC_CONFIG_CACHE'):
+                cache_filename = os.path.join(
+                    app.config['MAKESTATIC_CONFIG_CACHE'],
+                    'makestatic-%s-%s-%s.json' % ((__version__, ) + key)
+                )
+            rules = _load_cached_rules(cache_filename)
+            if rules is None:
+                rules = parser.parse_rules()
+                origin = 'parsed'
+                if cache_filename is not None:
+                    _store_cached_rules(cache_filename, rules)
+            else:
+                origin = 'loaded from %s' % cache_filename
+            matcher = _matchers[key] = parser.create_get_rule(rules)
+        else:
+            origin = 'reused'
+        app.logger.debug(
+            'Flask-MakeStatic: %s %s in %.3fs',
+            config_filename, origin, time.time() - start
+        )
+        return matcher
+
+    def _get_trees(self, app):
+        """
+        Returns the asset trees of `app` and of those of its blueprints, that
+        have an `assets.cfg` and a static folder of their own.
+        """
+        trees = [app.extensions['MakeStatic']]
+        for name in sorted(app.blueprints):
+            tree = self._get_blueprint_tree(app, name)
+            if tree is not None:
+                trees.append(tree)
+        return trees
+
+    def _get_blueprint_tree(self, app, name):
+        state = app.extensions['MakeStatic']
+        # Blueprints without an asset tree are remembered as None.
+        if name in state.blueprints:
+            return state.blueprints[name]
+        blueprint = app.blueprints.get(name)
+        if blueprint is None:
+            return None
+        tree = None
+        root_path = blueprint.root_path
+        if blueprint.has_static_folder and \
+                blueprint.static_folder != app.static_folder and \
+                not self._is_tree_root(app, root_path, name) and \
+                os.path.isfile(os.path.join(root_path, 'assets.cfg')) and \
+                os.path.isdir(os.path.join(root_path, 'assets')):
+            tree = _MakeStaticState(
+                self._parse_config(app, root_path),
+                blueprint.static_folder,
+                app.config.get('MAKESTATIC_RULE_CACHE_SIZE', 1024),
+                root_path, name
+            )
+            if app.config.get('MAKESTATIC_FINGERPRINT', False):
+                tree.load_url_manifest()
+        state.blueprints[name] = tree
+        return tree
+
+    def _is_tree_root(self, app, root_path, name):
+        """
+        Returns `True`, if `root_path` is the root of the tree of `app` or of
+        a blueprint whose name sorts before `name`. Blueprints declared in the
+        package of the application or of another blueprint share its assets,
+        which would otherwise be compiled once for each of them.
+        """
+        if os.path.abspath(root_path) == os.path.abspath(app.root_path):
+            return True
+        for other in sorted(app.blueprints):
+            if other >= name:
+                break
+            tree = self._get_blueprint_tree(app, other)
+            if tree is not None and \
+                    os.path.abspath(tree.root_path) == \
+                    os.path.abspath(root_path):
+                return True
+        return False
+
+    def _get_static_tree(self, endpoint):
+        """
+        Returns the asset tree whose static folder is served by `endpoint`
+        or `None`.
+        """
+        if endpoint == 'static':
+            return current_app.extensions['MakeStatic']
+        if endpoint is not None and endpoint.endswith('.static'):
+            return self._get_blueprint_tree(
+                current_app, endpoint[:-len('.static')]
+            )
+
+    def _url_defaults(self, endpoint, values):
+        # Registered with url_defaults(), so that url_for('static', ...)
+        # returns the URL of the fingerprinted file.
+        tree = self._get_static_tree(endpoint)
+        if tree is None or tree.url_manifest is None or \
+                'filename' not in values:
+            return
+        values['filename'] = tree.url_manifest.urls.get(
+            values['filename'], values['filename']
+        )
+
+    def _add_cache_control(self, response):
+        # Registered with after_request(), fingerprinted files never change
+        # and may be cached forever.
+        if response.status_code != 200:
+            return response
+        tree = self._get_static_tree(request.endpoint)
+        if tree is not None and tree.url_manifest is not None and \
+                request.view_args.get('filename') in \
+                tree.url_manifest.fingerprinted:
+            response.headers['Cache-Control'] = _immutable_cache_control
+        return response
+
+    def _get_tree(self, filename):
+        """
+        Returns the asset tree the asset `filename` belongs to.
+        """
+        trees = self._get_trees(self._get_app())
+        for tree in sorted(trees, key=lambda tree: -len(tree.assets_folder)):
+            if filename.startswith(tree.assets_folder + os.sep):
+                return tree
+        return trees[0]
+
+    def reload_config(self):
+        """
+        Parses `assets.cfg` again and returns a sorted list of the assets,
+        whose rule has changed and which therefore should be compiled again.
+
+        If `assets.cfg` cannot be parsed, the :class:`ParsingError` is raised
+        and the rules parsed previously remain in use.
+
+        .. versionadded:: 0.3.0
+        """
+        return self._reload_tree(self._get_app().extensions['MakeStatic'])
+
+    def _reload_tree(self, state):
+        matcher = self._parse_config(self._get_app(), state.root_path)
+        changed = []
+        for filename in self._iter_assets(state):
+            relative_filename = os.path.relpath(filename, state.assets_folder)
+            old, new = state.get_rule(relative_filename), matcher(
+                relative_filename
+            )
+            if old is None or new is None:
+                if old is not new:
+                    changed.append(filename)
+            elif old.digest != new.digest:
+                changed.append(filename)
+        state.set_matcher(matcher)
+        # Daemons are started again as needed, with the new configuration.
+        state.close_daemon_pools()
+        return changed
+
+    def _iter_assets(self, tree=None):
+        if tree is None:
+            tree = self._get_app().extensions['MakeStatic']
+        for root, directories, files in os.walk(tree.assets_folder):
+            directories.sort()
+            for file in sorted(files):
+                yield os.path.join(root, file)
 
     @property
     def assets_folder(self):
-        return os.path.join(self._get_app().root_path, 'assets')
+        return self._get_app().extensions['MakeStatic'].assets_folder
+
+    @property
+    def config_filename(self):
+        return self._get_app().extensions['MakeStatic'].config_filename
 
     def _get_app(self):
         if self.app is None:
             return current_app
         return self.app
 
+    def get_rule(self, filename):
+        """
+        Returns the :class:`Rule` for the given `filename`, relative to the
+        `assets` directory, or `None` if there is no such rule.
+
+        .. versionadded:: 0.3.0
+        """
+        return self._get_app().extensions['MakeStatic'].get_rule(filename)
+
+    def rule_cache_info(self):
+        """
+        Returns a named tuple with the `hits`, `misses`, `maxsize` and
+        `currsize` of the cache, that holds the rules found for each filename.
+        The size of the cache can be configured with the
+        `MAKESTATIC_RULE_CACHE_SIZE` configuration variable, it defaults to
+        ``1024``. The cache is cleared, whenever `assets.cfg` is parsed.
+
+        .. versionadded:: 0.3.0
+        """
+        return self._get_app().extensions['MakeStatic'].rule_cache.info()
+
     def get_commands(self, filename):
-        return self._get_app().extensions['MakeStatic'](filename)
+        rule = self.get_rule(filename)
+        if rule is not None:
+            return rule.commands
 
     def watch(self, sleep=0.1):
         """
@@ -212,11 +2130,50 @@ class MakeStatic(object):
         Returns a :class:`ThreadedWatcher`, if you want to turn of watching you
         can call :meth:`ThreadedWatcher.stop`.
 
+        On Linux changes are detected using inotify, elsewhere the `assets`
+        directory is polled for changes. You can choose either explicitly by
+        setting the `MAKESTATIC_WATCHER` configuration variable to
+        ``'inotify'`` or ``'polling'``, it defaults to ``'auto'``, which
+        polls as well, if inotify fails to watch all directories.
+
+        When polling, each poll looks at all files by default. For huge
+        trees, set the `MAKESTATIC_WATCH_BUDGET` configuration variable to
+        the number of seconds a single poll may take, the remaining files are
+        then looked at by the following polls.
+
+        Changes are not compiled immediately. Instead they are collected
+        until no further change has been detected for the number of seconds
+        given by the `MAKESTATIC_WATCH_DELAY` configuration variable, which
+        defaults to ``0.05``, and then compiled together. This way an asset
+        that is written several times in quick succession is compiled only
+        once.
+
+        Compilation happens on `MAKESTATIC_JOBS` separate threads, so that
+        slow compilers do not delay the detection of changes. If an asset
+        changes while it is being compiled, the compilation is cancelled and
+        started again.
+
+        If a file changes that other assets depend on, as determined by the
+        `scan` or `depfile` options of their rules, those assets are compiled
+        as well.
+
+        Changes to `assets.cfg` are detected as well, in which case the rules
+        are reloaded using :meth:`reload_config` and all assets whose rule has
+        changed are compiled.
+
+        All assets are compiled once, before watching begins, unless the
+        `MAKESTATIC_LAZY` configuration variable is `True`. In that case
+        assets are compiled when the files they produce are requested from
+        the static view and are missing or out of date.
+
         When run in a process started by the reloader, this does nothing to
         prevent the start of an unnecessary second watcher.
 
         :param sleep: The amount of time in seconds that should be slept
                       between checks for changes, may be ignored.
+
+        .. versionchanged:: 0.3.0
+           Added support for inotify and delayed compilation.
         """
         if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
             # We are running in the Werkzeug reloader, which runs the setup
@@ -225,29 +2182,165 @@ class MakeStatic(object):
             # assets twice. That is annoying to say the least, so we just
             # return and do nothing.
             return
-        watcher = ThreadedWatcher()
-        @watcher.file_added.connect
-        @new_app_context(self._get_app())
-        def on_file_added(filename):
+        app = self._get_app()
+        # Nested asset folders are matched before the folders containing them.
+        trees = sorted(
+            self._get_trees(app), key=lambda tree: -len(tree.assets_folder)
+        )
+        def get_tree(filename):
+            for tree in trees:
+                if filename.startswith(tree.assets_folder + os.sep):
+                    return tree
+        configs = dict((tree.config_filename, tree) for tree in trees)
+        # The directories are added first, so that no threads have been
+        # started yet, if watching them fails.
+        watcher = create_watcher(
+            app.config.get('MAKESTATIC_WATCHER', 'auto'),
+            app.config.get('MAKESTATIC_WATCH_BUDGET'),
+            [tree.assets_folder for tree in trees],
+            [tree.config_filename for tree in trees]
+        )
+        def on_error(filename, error):
             print(
-                u'Flask-MakeStatic: detected new asset %s, compiling' %
-                os.path.relpath(filename, self.assets_folder)
+                u'Flask-MakeStatic: failed to compile %s: %s' %
+                (get_tree(filename).describe(filename), error)
             )
-            self.compile_asset(filename)
+        queue = _CompileQueue(
+            self.compile_asset, on_error,
+            jobs=app.config.get('MAKESTATIC_JOBS', 1),
+            context=app.app_context
+        )
+        watcher.stopped.connect(queue.stop)
+        def reload_config(tree):
+            try:
+                with app.app_context():
+                    return self._reload_tree(tree)
+            except ParsingError as error:
+                print(
+                    u'Flask-MakeStatic: failed to reload %s, %s in line %d' %
+                    (describe_config(tree), error.message, error.lineno)
+                )
+                return []
+        def describe_config(tree):
+            if tree.name is None:
+                return u'assets.cfg'
+            return u'assets.cfg (%s)' % tree.name
+        def compile_changes(events):
+            filenames = set()
+            for config_filename, tree in iteritems(configs):
+                if events.pop(config_filename, 'removed') != 'removed':
+                    filenames.update(reload_config(tree))
+            for filename, event in iteritems(events):
+                tree = get_tree(filename)
+                if tree is None:
+                    continue
+                # Files that are only imported by other assets, need no rule.
+                if event != 'removed' and (
+                    tree.get_rule(
+                        os.path.relpath(filename, tree.assets_folder)
+                    )
+                    or not tree.dependencies.is_dependency(filename)
+                ):
+                    filenames.add(filename)
+                filenames.update(tree.dependencies.affected(filename))
+            for filename in sorted(filenames):
+                queue.submit(filename)
+        debouncer = Debouncer(
+            compile_changes, app.config.get('MAKESTATIC_WATCH_DELAY', 0.05)
+        )
+        watcher.stopped.connect(debouncer.stop)
+        @watcher.file_added.connect
+        def on_file_added(filename):
+            if not debouncer.add(filename, 'added'):
+                return
+            if filename in configs:
+                print(u'Flask-MakeStatic: detected change in %s, reloading' %
+                      describe_config(configs[filename]))
+            else:
+                print(
+                    u'Flask-MakeStatic: detected new asset %s, compiling' %
+                    get_tree(filename).describe(filename)
+                )
         @watcher.file_modified.connect
-        @new_app_context(self._get_app())
         def on_file_modified(filename):
-            print(
-                u'Flask-MakeStatic: detected change in %s, compiling' %
-                os.path.relpath(filename, self.assets_folder)
-            )
-            self.compile_asset(filename)
-        watcher.add_directory(self.assets_folder)
+            if not debouncer.add(filename, 'modified'):
+                return
+            if filename in configs:
+                print(u'Flask-MakeStatic: detected change in %s, reloading' %
+                      describe_config(configs[filename]))
+            else:
+                print(
+                    u'Flask-MakeStatic: detected change in %s, compiling' %
+                    get_tree(filename).describe(filename)
+                )
+        @watcher.file_removed.connect
+        def on_file_removed(filename):
+            debouncer.add(filename, 'removed')
         watcher.watch(sleep=sleep)
-        self.compile() # initial compile
+        if not app.config.get('MAKESTATIC_LAZY', False):
+            self.compile() # initial compile
         return watcher
 
-    def compile(self):
+    def _serve_lazily(self, view, endpoint):
+        """
+        Wraps the static `view` of `endpoint`, so that the asset producing the
+        requested file is compiled, if the file is missing or out of date.
+        """
+        @wraps(view)
+        def wrapper(filename, **kwargs):
+            state = self._get_static_tree(endpoint)
+            found = None
+            if state is not None:
+                found = self._find_asset(state, filename)
+            if found is not None:
+                asset, rule, substitutions, outputs = found
+                # Concurrent requests wait for a single compilation.
+                with state.get_asset_lock(asset):
+                    dependencies = self._find_dependencies(
+                        state, asset, rule, substitutions
+                    )
+                    if not self._is_up_to_date(
+                        state, asset, outputs, dependencies
+                    ):
+                        self.compile_asset(asset)
+            return view(filename, **kwargs)
+        return wrapper
+
+    def _find_asset(self, state, filename):
+        """
+        Returns the asset in the asset tree `state`, whose rule produces the
+        file with the given `filename` relative to the static folder of the
+        tree, along with the rule, the substitutions and the outputs, or
+        `None`.
+
+        The asset has to be in the corresponding directory and have the same
+        name, or the same name without the extension and a rule that declares
+        the file as an output.
+        """
+        static = safe_join(state.static_folder, filename)
+        directory, basename = os.path.split(os.path.normpath(filename))
+        assets_directory = os.path.join(state.assets_folder, directory)
+        try:
+            names = os.listdir(assets_directory)
+        except OSError:
+            return None
+        base = os.path.splitext(basename)[0]
+        for name in sorted(names, key=lambda name: name != basename):
+            if name != basename and os.path.splitext(name)[0] != base:
+                continue
+            asset = os.path.join(assets_directory, name)
+            rule = state.get_rule(os.path.relpath(asset, state.assets_folder))
+            if rule is None or not os.path.isfile(asset):
+                continue
+            substitutions = self._get_substitutions(state, asset)
+            outputs = [
+                output.format(**substitutions) for output in rule.outputs
+            ] or [substitutions['static']]
+            if static in outputs:
+                return asset, rule, substitutions, outputs
+
+    def compile(self, jobs=None, fail_fast=False, incremental=None,
+                fingerprint=None, precompress=None, profile=None):
         """
         Compiles all assets to static files in one go.
 
@@ -256,32 +2349,371 @@ class MakeStatic(object):
 
         Emits a :class:`RuleMissing` warning for each file in `assets` for
         which no rule exists.
+
+        Assets are independent of each other, so up to `jobs` of them are
+        compiled concurrently, the commands of a single asset are still
+        executed one after another. If `jobs` is not given, the
+        `MAKESTATIC_JOBS` configuration variable is used, which defaults to
+        ``1``.
+
+        If any asset fails to compile, a :class:`CompilationError` is raised
+        once all other assets have been compiled. If `fail_fast` is `True`,
+        assets following a failed one are not compiled and the error only
+        reports the first asset that failed, in the order in which the assets
+        would have been compiled sequentially, regardless of `jobs`. Assets
+        following it, that were compiled concurrently, may have been compiled
+        nonetheless.
+
+        Besides the assets of the application, the assets of blueprints that
+        have an `assets.cfg` and a static folder of their own are compiled.
+
+        `incremental` is passed on to :meth:`compile_asset`, if it is not
+        given the `MAKESTATIC_INCREMENTAL` configuration variable is used,
+        which defaults to `False`. In the ``'hash'`` mode the build manifest
+        is written to the static folder, once all assets have been compiled.
+
+        If `fingerprint` is `True`, a copy of each file in the static folder
+        is created, whose name contains a hash of its content, and
+        ``url_for('static', filename=...)`` returns the URL of that copy. If
+        `fingerprint` is not given, the `MAKESTATIC_FINGERPRINT` configuration
+        variable is used, which defaults to `False`.
+
+        If `precompress` is `True`, a gzip compressed copy with the extension
+        ``.gz`` is created of each file in the static folder, that is at least
+        `MAKESTATIC_PRECOMPRESS_MIN_SIZE` bytes large, and a brotli compressed
+        one with the extension ``.br``, if the :mod:`brotli` module is
+        installed. Copies that are newer than the file are kept. If
+        `precompress` is not given, the `MAKESTATIC_PRECOMPRESS` configuration
+        variable is used, which defaults to `False`.
+
+        If `profile` is a filename, a report of the time it took to compile
+        each asset and the commands executed for it is written to that file
+        as JSON, along with a summary ranking the slowest rules and assets,
+        that is written to a file with the same name and the extension
+        ``.txt``. If `profile` is not given, the `MAKESTATIC_PROFILE`
+        configuration variable is used, which defaults to `None`.
+
+        .. versionchanged:: 0.3.0
+           Added `jobs`, `fail_fast`, `incremental`, `fingerprint`,
+           `precompress` and `profile`.
         """
-        for root, _, files in os.walk(self.assets_folder):
-            for file in files:
-                self.compile_asset(os.path.join(root, file))
+        app = self._get_app()
+        if jobs is None:
+            jobs = app.config.get('MAKESTATIC_JOBS', 1)
+        if incremental is None:
+            incremental = app.config.get('MAKESTATIC_INCREMENTAL', False)
+        if fingerprint is None:
+            fingerprint = app.config.get('MAKESTATIC_FINGERPRINT', False)
+        if precompress is None:
+            precompress = app.config.get('MAKESTATIC_PRECOMPRESS', False)
+        if profile is None:
+            profile = app.config.get('MAKESTATIC_PROFILE')
+        if profile is not None:
+            collector = _Profile(app.root_path)
+            self.asset_compiled.connect(collector.add)
+        try:
+            self._compile(app, jobs, fail_fast, incremental, fingerprint,
+                          precompress)
+        finally:
+            if profile is not None:
+                self.asset_compiled.disconnect(collector.add)
+                collector.save(profile)
 
-    def compile_asset(self, filename):
-        relative_filename = os.path.relpath(filename, self.assets_folder)
-        commands = self.get_commands(relative_filename)
-        if commands is None:
+    def _compile(self, app, jobs, fail_fast, incremental, fingerprint,
+                 precompress):
+        trees = self._get_trees(app)
+        assets = [
+            (tree, filename)
+            for tree in trees for filename in self._iter_assets(tree)
+        ]
+        if incremental == 'hash':
+            # Reload the manifests, in case they have been changed by another
+            # process since we last compiled.
+            for tree in trees:
+                tree.load_manifest()
+        # The assets of all trees share the same threads.
+        failures = [
+            (filename, error) for (_, filename), error in run_jobs(
+                # The static folders are fingerprinted and precompressed
+                # below, all at once.
+                lambda asset: self._compile_asset(
+                    asset[0], asset[1], incremental, fingerprint=False,
+                    precompress=False
+                ),
+                assets, jobs=jobs, fail_fast=fail_fast,
+                context=app.app_context
+            )
+        ]
+        if incremental == 'hash':
+            for tree in trees:
+                tree.manifest.prune(
+                    os.path.relpath(filename, tree.assets_folder)
+                    for asset_tree, filename in assets if asset_tree is tree
+                )
+                tree.manifest.save()
+        if fingerprint:
+            for tree in trees:
+                url_manifest = tree.load_url_manifest()
+                url_manifest.update()
+                url_manifest.save()
+        if precompress:
+            min_size = app.config.get(
+                'MAKESTATIC_PRECOMPRESS_MIN_SIZE', 1024
+            )
+            failures.extend(run_jobs(_precompress, [
+                filename for tree in trees for filename in
+                _find_compressible(tree.static_folder, min_size)
+            ], jobs=jobs))
+        if failures:
+            raise CompilationError(failures)
+
+    def compile_asset(self, filename, incremental=False):
+        """
+        Compiles the asset with the given `filename` and returns `True`, if
+        the asset has been compiled.
+
+        The outputs of an asset are the files declared by the `outputs` option
+        of its rule or, if it has none, the file in the static folder with the
+        name of the asset.
+
+        If `incremental` is ``'mtime'``, the asset is not compiled if all of
+        its outputs exist and have been modified more recently than the
+        asset, the files it depends on and `assets.cfg`.
+
+        If `incremental` is ``'hash'``, the asset is not compiled if neither
+        its content, the content of the files it depends on nor the commands
+        and options of its rule have changed, since it was last compiled, and
+        its outputs still exist. This information is kept in a build manifest,
+        which is only written by :meth:`compile`.
+
+        The files an asset depends on are determined using the `scan` and
+        `depfile` options of its rule.
+
+        Unless the `MAKESTATIC_ATOMIC_WRITES` configuration variable is
+        `False`, the `static` and `static_base` substitutions, and therefore
+        the declared outputs based on them, refer to a staging directory
+        within the static folder. Once all commands have succeeded, the files
+        written there are moved to the static folder, replacing the previous
+        versions atomically. `static_dir` always refers to the static folder
+        itself.
+
+        If the rule has a `daemon` option, the asset is compiled by a compiler
+        daemon, instead of executing the commands in a shell. Up to
+        `MAKESTATIC_DAEMONS` instances of each daemon are started, as they
+        are needed. This defaults to the number of CPUs.
+
+        The asset may belong to the asset tree of the application or of one
+        of its blueprints, in which case the rules in the `assets.cfg` of the
+        blueprint are used and it is compiled to the static folder of the
+        blueprint.
+
+        If the `MAKESTATIC_FINGERPRINT` configuration variable is `True`,
+        fingerprinted copies of the files the asset has been compiled to are
+        created and ``url_for('static', ...)`` returns their URLs. If the
+        `MAKESTATIC_PRECOMPRESS` configuration variable is `True`, the
+        compressed copies of these files are updated as well.
+
+        .. versionchanged:: 0.3.0
+           Added `incremental` and the return value.
+        """
+        return self._compile_asset(self._get_tree(filename), filename,
+                                   incremental)
+
+    def _compile_asset(self, state, filename, incremental=False,
+                       fingerprint=None, precompress=None):
+        if incremental not in (False, 'mtime', 'hash'):
+            raise ValueError('unknown incremental mode: %r' % incremental)
+        relative_filename = os.path.relpath(filename, state.assets_folder)
+        rule = state.get_rule(relative_filename)
+        if rule is None:
             warnings.warn(
-                'cannot find a rule for %s' % relative_filename,
+                'cannot find a rule for %s' % state.describe(filename),
                 RuleMissing,
             )
+            return False
+        app = self._get_app()
+        substitutions = self._get_substitutions(state, filename)
+        # Rules without declared outputs compile to the file in the static
+        # folder with the name of the asset.
+        outputs = [
+            output.format(**substitutions) for output in rule.outputs
+        ] or [substitutions['static']]
+        dependencies = self._find_dependencies(
+            state, filename, rule, substitutions
+        )
+        if incremental == 'mtime' and self._is_up_to_date(
+            state, filename, outputs, dependencies
+        ):
+            state.dependencies.update(filename, dependencies)
+            return False
+        if incremental == 'hash':
+            manifest = state.manifest
+            asset_hash = hash_file(filename)
+            if manifest.is_current(
+                relative_filename, asset_hash, rule,
+                self._hash_dependencies(state, dependencies)
+            ):
+                state.dependencies.update(filename, dependencies)
+                return False
+            manifest.discard(relative_filename)
+        timings = []
+        start = time.time()
+        try:
+            if app.config.get('MAKESTATIC_ATOMIC_WRITES', True):
+                with _staged_outputs(
+                    state.static_folder, relative_filename
+                ) as staging_dir:
+                    self._run_rule(state, rule, self._get_substitutions(
+                        state, filename, staging_dir=staging_dir
+                    ), timings)
+            else:
+                self._run_rule(state, rule, substitutions, timings)
+        except _Cancelled:
+            raise
+        except Exception as error:
+            self._send_asset_timing(
+                filename, rule, time.time() - start, timings, [], error
+            )
+            raise
+        self._send_asset_timing(
+            filename, rule, time.time() - start, timings, outputs
+        )
+        compiled = outputs
+        if fingerprint is None:
+            fingerprint = app.config.get('MAKESTATIC_FINGERPRINT', False)
+        if fingerprint:
+            url_manifest = state.url_manifest or state.load_url_manifest()
+            compiled = compiled + url_manifest.update_files(compiled)
+            url_manifest.save()
+        if precompress is None:
+            precompress = app.config.get('MAKESTATIC_PRECOMPRESS', False)
+        if precompress:
+            min_size = app.config.get('MAKESTATIC_PRECOMPRESS_MIN_SIZE', 1024)
+            for output in compiled:
+                _update_precompressed(output, min_size)
+        if rule.depfile is not None:
+            # The depfile has been written by the commands we just executed.
+            dependencies = self._find_dependencies(
+                state, filename, rule, substitutions
+            )
+        state.dependencies.update(filename, dependencies)
+        if incremental == 'hash':
+            manifest.record(
+                relative_filename, asset_hash, rule, outputs,
+                self._hash_dependencies(state, dependencies)
+            )
+        return True
+
+    def _run_rule(self, state, rule, substitutions, timings):
+        if rule.daemon is None:
+            for command in rule.command_templates:
+                self._time_command(
+                    substitutions['asset'],
+                    command.template.format(**substitutions),
+                    timings, partial(command.run, **substitutions)
+                )
         else:
-            static = os.path.join(self._get_app().static_folder, relative_filename)
-            static_base = os.path.splitext(static)[0]
-            for command in commands:
-                subprocess.check_call(
-                    command.format(
-                        asset=filename,
-                        static=static,
-                        static_dir=self._get_app().static_folder,
-                        static_base=static_base
-                    ),
-                    shell=True
+            app = self._get_app()
+            # Each asset tree has daemons of its own, so that they are
+            # restarted, when the configuration of the tree is reloaded.
+            pool = state.get_daemon_pool(
+                rule.daemon.format(root_path=state.root_path),
+                app.config['MAKESTATIC_DAEMONS']
+            )
+            request = dict(substitutions, commands=[
+                command.format(**substitutions) for command in rule.commands
+            ])
+            # The daemon does the work, so we cannot tell how much CPU time
+            # it took.
+            self._time_command(
+                substitutions['asset'], rule.daemon, timings,
+                lambda: pool.run(request)
+            )
+
+    def _send_asset_timing(self, filename, rule, wall_time, timings,
+                           outputs, error=None):
+        if self.asset_compiled.listeners:
+            self.asset_compiled.send(AssetTiming(
+                filename, rule.pattern, wall_time, _sum_cpu_times(timings),
+                _get_output_size(outputs), error, timings
+            ))
+
+    def _time_command(self, asset, command, timings, function):
+        returncode = cpu_time = None
+        start = time.time()
+        try:
+            cpu_time = function()
+            returncode = 0
+        except subprocess.CalledProcessError as error:
+            returncode = error.returncode
+            cpu_time = getattr(error, 'cpu_time', None)
+            raise
+        finally:
+            timing = CommandTiming(
+                asset, command, time.time() - start, cpu_time, returncode
+            )
+            timings.append(timing)
+            if self.command_executed.listeners:
+                self.command_executed.send(timing)
+
+    def _find_dependencies(self, state, filename, rule, substitutions):
+        dependencies = set()
+        if rule.depfile is not None:
+            # Commands are executed in our working directory, so relative
+            # paths in the depfile are relative to it.
+            dependencies.update(
+                os.path.abspath(dependency)
+                for dependency in parse_depfile(
+                    rule.depfile.format(**substitutions)
                 )
+            )
+        if rule.scanner is not None:
+            dependencies.update(scan_dependencies(
+                filename, rule.scanner, [state.assets_folder]
+            ))
+        dependencies.discard(filename)
+        return dependencies
+
+    def _hash_dependencies(self, state, dependencies):
+        hashes = {}
+        for dependency in dependencies:
+            try:
+                dependency_hash = hash_file(dependency)
+            except EnvironmentError:
+                dependency_hash = None
+            hashes[os.path.relpath(dependency, state.assets_folder)] = \
+                dependency_hash
+        return hashes
+
+    def _get_substitutions(self, state, filename, staging_dir=None):
+        relative_filename = os.path.relpath(filename, state.assets_folder)
+        # Commands may read files compiled earlier from the static folder, so
+        # only the files of this asset are staged.
+        static = os.path.join(
+            staging_dir or state.static_folder, relative_filename
+        )
+        return {
+            'asset': filename,
+            'static': static,
+            'static_dir': state.static_folder,
+            'static_base': os.path.splitext(static)[0]
+        }
+
+    def _is_up_to_date(self, state, filename, outputs, dependencies=()):
+        if not outputs:
+            return False
+        inputs = [filename, state.config_filename] + list(dependencies)
+        try:
+            newest_input = max(os.stat(path).st_mtime for path in inputs)
+        except OSError:
+            return False
+        for output in outputs:
+            try:
+                if os.stat(output).st_mtime < newest_input:
+                    return False
+            except OSError:
+                return False
+        return True
 
 
 __all__ = ['MakeStatic']
@@ -12,6 +12,15 @@ import sys
 PY2 = sys.version_info[0] == 2
 
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
 if PY2:
     def iteritems(d):
         return d.iteritems()
@@ -24,4 +33,4 @@ else:
     from io import StringIO
 
 
-__all__ = ['PY2', 'iteritems', 'StringIO']
+__all__ = ['PY2', 'iteritems', 'StringIO', 'scandir']
@@ -0,0 +1,122 @@
+# coding: utf-8
+"""
+    flask.ext.makestatic._inotify
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A minimal ctypes binding to the inotify API of Linux.
+
+    :copyright: 2013 by Daniel Neuhäuser
+    :license: BSD, see LICENSE.rst for details
+"""
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from flask.ext.makestatic._compat import PY2
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+
+_event = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True
+        )
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32
+    ]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+_libc = _load_libc()
+
+
+def is_available():
+    return _libc is not None
+
+
+def _check(result):
+    if result == -1:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+def init():
+    return _check(_libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK))
+
+
+def add_watch(fd, path, mask):
+    if not isinstance(path, bytes):
+        if PY2:
+            path = path.encode(sys.getfilesystemencoding())
+        else:
+            path = os.fsencode(path)
+    return _check(_libc.inotify_add_watch(fd, path, mask))
+
+
+def rm_watch(fd, wd):
+    try:
+        _check(_libc.inotify_rm_watch(fd, wd))
+    except OSError as error:
+        # The watch is removed automatically, if the watched path is deleted.
+        if error.errno != errno.EINVAL:
+            raise
+
+
+def read_events(fd, bufsize=64 * 1024):
+    """
+    Reads all pending events from `fd` and returns a list of
+    ``(wd, mask, cookie, name)`` tuples, `name` is `None` for events on the
+    watched path itself.
+    """
+    try:
+        data = os.read(fd, bufsize)
+    except OSError as error:
+        if error.errno == errno.EAGAIN:
+            return []
+        raise
+    events = []
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = _event.unpack_from(data, offset)
+        offset += _event.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        if not name:
+            name = None
+        elif not PY2:
+            name = os.fsdecode(name)
+        events.append((wd, mask, cookie, name))
+    return events
@@ -7,31 +7,406 @@
     :license: BSD, see LICENSE.rst for details
 """
 import os
+import stat
 import time
 import errno
+import select
+import weakref
 import threading
+import traceback
+from functools import partial
+from collections import deque
 
-from flask.ext.makestatic._compat import iteritems
+from flask.ext.makestatic import _inotify
+from flask.ext.makestatic._compat import iteritems, scandir
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+
+class _ThreadPool(object):
+    """
+    Calls functions on up to `size` daemon threads, which are started when
+    functions are submitted and exit once there is nothing left to do.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._functions = deque()
+        self._threads = 0
+        self._lock = threading.Lock()
+
+    def submit(self, function):
+        with self._lock:
+            self._functions.append(function)
+            if self._threads >= self.size:
+                return
+            self._threads += 1
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._functions:
+                    self._threads -= 1
+                    return
+                function = self._functions.popleft()
+            try:
+                function()
+            except Exception:
+                traceback.print_exc()
+
+
+#: The pool shared by all listeners connected with ``mode='thread'``.
+_dispatch_pool = _ThreadPool(4)
+
+
+class _Listener(object):
+    def __init__(self, function, mode, weak, loop, batch, disconnect):
+        self.mode = mode
+        self.loop = loop
+        self.batch = batch
+        #: `True` if the function can be called directly by the signal.
+        self.direct = mode == 'inline' and not weak and not batch
+        self._disconnect = disconnect
+        self._pending = deque()
+        self._scheduled = False
+        self._lock = threading.Lock()
+        if not weak:
+            self._get_function = lambda: function
+        elif getattr(function, '__self__', None) is not None:
+            # Bound methods are created on attribute access, so we have to
+            # refer to the instance instead.
+            instance = weakref.ref(function.__self__, disconnect)
+            method = function.__func__
+            def get_function():
+                obj = instance()
+                if obj is not None:
+                    return method.__get__(obj, type(obj))
+            self._get_function = get_function
+        else:
+            self._get_function = weakref.ref(function, disconnect)
+
+    @property
+    def function(self):
+        return self._get_function()
+
+    def dispatch(self, function, calls):
+        """
+        Calls `function` with each of the ``(args, kwargs)`` tuples in
+        `calls`, according to the mode of this listener.
+        """
+        if self.mode == 'inline':
+            for args, kwargs in calls:
+                function(*args, **kwargs)
+        elif self.mode == 'thread':
+            with self._lock:
+                self._pending.extend(
+                    partial(function, *args, **kwargs) for args, kwargs in calls
+                )
+                if self._scheduled:
+                    return
+                self._scheduled = True
+            _dispatch_pool.submit(self._drain)
+        elif self.loop.is_closed():
+            self._disconnect()
+        elif asyncio.iscoroutinefunction(function):
+            for args, kwargs in calls:
+                asyncio.run_coroutine_threadsafe(
+                    function(*args, **kwargs), self.loop
+                )
+        else:
+            self.loop.call_soon_threadsafe(
+                _call_all, [
+                    partial(function, *args, **kwargs)
+                    for args, kwargs in calls
+                ]
+            )
+
+    def _drain(self):
+        # Calls are made one after another, so that the listener sees them
+        # in the order in which they have been sent, even though they are
+        # made on a pool of threads.
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._scheduled = False
+                    return
+                call = self._pending.popleft()
+            try:
+                call()
+            except Exception:
+                traceback.print_exc()
+
+
+def _call_all(functions):
+    for function in functions:
+        function()
 
 
 class Signal(object):
+    """
+    Calls the listeners connected to it, whenever it is sent.
+
+    By default listeners are called in the thread sending the signal, one
+    after another. Listeners connected with ``mode='thread'`` are called on a
+    pool of threads shared by all signals and listeners connected with
+    ``mode='asyncio'`` are scheduled on an asyncio event loop instead, so that
+    slow listeners do not delay the sender. Either way, each listener is
+    called in the order in which the signal has been sent.
+
+    Inline listeners, that are neither weak nor batched, are called first
+    and directly, so that sending stays cheap.
+    """
     def __init__(self):
         self.listeners = []
+        self._direct = []
+        self._dispatched = []
+        self._lock = threading.Lock()
 
     def send(self, *args, **kwargs):
-        for listener in self.listeners:
-            listener(*args, **kwargs)
+        for function in self._direct:
+            function(*args, **kwargs)
+        if not self._dispatched:
+            return
+        if len(args) == 1 and not kwargs:
+            item = args[0]
+        else:
+            item = args
+        for listener in self._dispatched:
+            function = listener.function
+            if function is None:
+                continue
+            if listener.batch:
+                listener.dispatch(function, [(([item], ), {})])
+            else:
+                listener.dispatch(function, [(args, kwargs)])
+
+    def send_many(self, items):
+        """
+        Sends the signal once for each of the `items`, with the item as the
+        only argument.
+
+        Listeners that are not called inline receive all items in one go,
+        instead of one at a time, and listeners connected with ``batch=True``
+        are called only once with the list of `items`.
+        """
+        items = list(items)
+        for item in items:
+            for function in self._direct:
+                function(item)
+        if not items:
+            return
+        for listener in self._dispatched:
+            function = listener.function
+            if function is None:
+                continue
+            if listener.batch:
+                listener.dispatch(function, [((items, ), {})])
+            else:
+                listener.dispatch(function, [((item, ), {}) for item in items])
+
+    def connect(self, function=None, mode='inline', weak=False, loop=None,
+                batch=False):
+        """
+        Connects `function` to this signal and returns it, so that this can
+        be used as a decorator. If only keyword arguments are given, a
+        decorator is returned instead.
+
+        `mode` is ``'inline'``, ``'thread'`` or ``'asyncio'``. In the latter
+        case `function` is scheduled on `loop`, which defaults to the current
+        event loop, and may be a coroutine function. The listener is
+        disconnected, once the loop has been closed.
+
+        If `weak` is `True`, only a weak reference to `function` is kept and
+        it is disconnected, once it has been garbage collected.
 
-    def connect(self, function):
-        self.listeners.append(function)
+        If `batch` is `True`, `function` is called with a list of the
+        arguments the signal has been sent with, see :meth:`send_many`.
+        Signals sent with more than one argument, are passed as tuples.
+        """
+        if function is None:
+            return partial(
+                self.connect, mode=mode, weak=weak, loop=loop, batch=batch
+            )
+        if mode not in ('inline', 'thread', 'asyncio'):
+            raise ValueError('unknown mode: %r' % mode)
+        if mode == 'asyncio':
+            if asyncio is None:
+                raise RuntimeError('asyncio is not available')
+            if loop is None:
+                loop = asyncio.get_event_loop()
+        def disconnect(reference=None):
+            self._remove(listener)
+        listener = _Listener(function, mode, weak, loop, batch, disconnect)
+        with self._lock:
+            self._set_listeners(self.listeners + [listener])
         return function
 
+    def disconnect(self, function):
+        for listener in self.listeners:
+            if listener.function == function:
+                self._remove(listener)
+                return
+        raise ValueError('%r is not connected' % function)
+
+    def _remove(self, listener):
+        with self._lock:
+            self._set_listeners([
+                connected for connected in self.listeners
+                if connected is not listener
+            ])
+
+    def _set_listeners(self, listeners):
+        # Sending iterates over the lists without holding the lock, so they
+        # are replaced instead of being modified.
+        self.listeners = listeners
+        self._direct = [
+            listener.function for listener in listeners if listener.direct
+        ]
+        self._dispatched = [
+            listener for listener in listeners if not listener.direct
+        ]
+
+
+def _stat_key(stat_result):
+    """
+    Returns an ``(inode, size, mtime_ns)`` tuple, which changes whenever the
+    file it describes is modified or replaced.
+    """
+    mtime_ns = getattr(stat_result, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat_result.st_mtime * 1e9)
+    return stat_result.st_ino, stat_result.st_size, mtime_ns
+
+
+def scan(directory):
+    """
+    Returns a dictionary mapping the paths of the entries in `directory` to
+    their :func:`_stat_key`, or `None` if the entry is a directory. Entries
+    that are neither files nor directories are left out.
+    """
+    entries = {}
+    if scandir is None:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat_result = os.stat(path)
+            except OSError as error:
+                if error.errno == errno.ENOENT:
+                    continue
+                raise
+            if stat.S_ISDIR(stat_result.st_mode):
+                entries[path] = None
+            elif stat.S_ISREG(stat_result.st_mode):
+                entries[path] = _stat_key(stat_result)
+        return entries
+    for entry in scandir(directory):
+        try:
+            if entry.is_dir():
+                entries[entry.path] = None
+            elif entry.is_file():
+                entries[entry.path] = _stat_key(entry.stat())
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                continue
+            raise
+    return entries
+
+
+def _merge_events(previous, event):
+    if previous is None or previous == event:
+        return event
+    elif previous == 'added':
+        return None if event == 'removed' else 'added'
+    elif previous == 'removed':
+        return 'modified' if event == 'added' else event
+    return event
+
+
+class Debouncer(object):
+    """
+    Collects events for paths and calls `callback` with a dictionary mapping
+    each path to the event that sums up what happened to it, once no further
+    event has been added for `delay` seconds.
+
+    Events are ``'added'``, ``'modified'`` and ``'removed'``. A path that is
+    added and removed again before the callback is called, is dropped. The
+    callback is called in a separate daemon thread.
+    """
+    def __init__(self, callback, delay=0.05):
+        self.callback = callback
+        self.delay = delay
+        self._events = {}
+        self._last_added = None
+        self._condition = threading.Condition()
+        self._stopped = False
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, path, event):
+        """
+        Adds an `event` for `path` and returns `True`, if no event was pending
+        for `path`.
+        """
+        with self._condition:
+            is_new = path not in self._events
+            merged = _merge_events(self._events.get(path), event)
+            if merged is None:
+                del self._events[path]
+            else:
+                self._events[path] = merged
+            self._last_added = time.time()
+            self._condition.notify()
+            return is_new
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if not self._events:
+                        self._condition.wait()
+                        continue
+                    remaining = self._last_added + self.delay - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._stopped:
+                    return
+                events, self._events = self._events, {}
+            try:
+                self.callback(events)
+            except Exception:
+                traceback.print_exc()
+
 
 class Watcher(object):
-    def __init__(self):
+    """
+    Looks for changes in the watched files and directories by polling them.
+
+    If `budget` is given, each poll stops looking for changes after about
+    `budget` seconds and the next one continues where it stopped. This keeps
+    every poll short for huge trees, the time it takes to detect a change is
+    then bounded by the number of polls it takes to get through the whole
+    tree.
+    """
+    def __init__(self, budget=None):
         self.files = {}
         self.directories = {}
+        self.budget = budget
         self._lock = threading.RLock()
+        # The directories and files that remain to be examined in the
+        # current pass, only used by the polling thread.
+        self._pending = deque()
 
         self.file_added = Signal()
         self.file_modified = Signal()
@@ -41,86 +416,405 @@ class Watcher(object):
         self.directory_modified = Signal()
         self.directory_removed = Signal()
 
-        self._stopped = False
+        self.stopped = Signal()
 
-    def _listdir(self, directory):
-        return set(os.path.join(directory, f) for f in os.listdir(directory))
+        self._stopped = False
 
     def add_file(self, file):
         with self._lock:
-            self.files[file] = os.stat(file).st_mtime
+            self.files[file] = _stat_key(os.stat(file))
 
     def add_directory(self, directory, ignore_contained=True):
         with self._lock:
-            paths = self._listdir(directory)
+            entries = scan(directory)
             if ignore_contained:
-                self.directories[directory] = paths
+                self.directories[directory] = set(entries)
             else:
+                # Contained files and directories will be reported as added
+                # by the next poll.
                 self.directories[directory] = set()
-            for path in paths:
-                if os.path.isfile(path):
-                    self.add_file(path)
-                elif os.path.isdir(path):
+            for path, key in iteritems(entries):
+                if key is None:
                     self.add_directory(path, ignore_contained=ignore_contained)
+                elif ignore_contained:
+                    self.files[path] = key
 
     def stop(self):
         self._stopped = True
+        self.stopped.send()
 
     def watch(self, sleep=0.1):
         while not self._stopped:
+            self.poll(self.budget)
+            time.sleep(sleep)
+
+    def poll(self, budget=None):
+        """
+        Looks for changes in the watched directories and files, sending the
+        corresponding signals, and returns `True` if a pass over all of them
+        has been completed.
+
+        Without a `budget` a complete pass is made. Otherwise the pass is
+        interrupted after about `budget` seconds, at least one directory or
+        file is examined, and continued by the next call.
+
+        The lock is only held while the changes that have been found are
+        applied, so that :meth:`add_file` and :meth:`add_directory` are not
+        blocked while the file system is examined.
+        """
+        if budget is None:
+            self._pending.clear()
+        if not self._pending:
             with self._lock:
-                new_directories = []
-                removed_directories = []
-                for directory, seen in iteritems(self.directories):
-                    try:
-                        current = self._listdir(directory)
-                    except OSError as error:
-                        if error.errno == errno.ENOENT:
-                            self.directory_removed.send(directory)
-                            removed_directories.append(directory)
-                        else:
-                            raise
+                self._pending.extend(
+                    (True, directory) for directory in self.directories
+                )
+                self._pending.extend(
+                    (False, file) for file in self.files
+                    if os.path.dirname(file) not in self.directories
+                )
+        deadline = None if budget is None else time.time() + budget
+        found = []
+        while self._pending:
+            is_directory, path = self._pending.popleft()
+            if is_directory:
+                found.append((True, path, _scan_if_exists(directory=path)))
+            else:
+                found.append((False, path, _scan_if_exists(file=path)))
+            if deadline is not None and time.time() >= deadline:
+                break
+        new_directories = []
+        with self._lock:
+            for is_directory, path, result in found:
+                if is_directory:
+                    self._apply_directory(path, result, new_directories)
+                else:
+                    self._apply_file(path, result)
+        for directory in new_directories:
+            try:
+                self.add_directory(directory, ignore_contained=False)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+        return not self._pending
+
+    def _apply_directory(self, directory, entries, new_directories):
+        seen = self.directories.get(directory)
+        if seen is None:
+            # The directory has been removed, while we were scanning it.
+            return
+        if entries is None:
+            self.directory_removed.send(directory)
+            del self.directories[directory]
+            removed = [path for path in sorted(seen) if path in self.files]
+            for path in removed:
+                del self.files[path]
+            self.file_removed.send_many(removed)
+            return
+        current = set(entries)
+        for path in current - seen:
+            self.directory_modified.send(directory)
+            if entries[path] is None:
+                new_directories.append(path)
+                self.directory_added.send(path)
+            else:
+                self.files[path] = entries[path]
+                self.file_added.send(path)
+        for path in seen - current:
+            self.directory_modified.send(directory)
+            # Removed directories are reported, once they fail to be
+            # scanned.
+            if path in self.files:
+                del self.files[path]
+                self.file_removed.send(path)
+        for path in current & seen:
+            key = entries[path]
+            if key is not None and self.files.get(path, key) != key:
+                self.files[path] = key
+                self.file_modified.send(path)
+                self.directory_modified.send(directory)
+        self.directories[directory] = current
+
+    def _apply_file(self, file, key):
+        if file not in self.files:
+            return
+        if key is None:
+            del self.files[file]
+            self.file_removed.send(file)
+        elif key != self.files[file]:
+            self.files[file] = key
+            self.file_modified.send(file)
+            directory = os.path.dirname(file)
+            if directory in self.directories:
+                self.directory_modified.send(directory)
+
+
+def _scan_if_exists(directory=None, file=None):
+    """
+    Returns the result of :func:`scan` for `directory` or the
+    :func:`_stat_key` of `file`, or `None` if it does not exist.
+    """
+    try:
+        if directory is not None:
+            return scan(directory)
+        return _stat_key(os.stat(file))
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return None
+        raise
+
+
+class InotifyWatcher(Watcher):
+    """
+    A :class:`Watcher` that is notified about changes by the kernel using
+    inotify, instead of looking for them. This is only available on Linux,
+    use :func:`create_watcher` to get the best available watcher.
+
+    The same signals are sent as by :class:`Watcher`.
+    """
+    _mask = (
+        _inotify.IN_CREATE | _inotify.IN_DELETE | _inotify.IN_MOVED_FROM |
+        _inotify.IN_MOVED_TO | _inotify.IN_CLOSE_WRITE | _inotify.IN_ATTRIB |
+        _inotify.IN_DELETE_SELF | _inotify.IN_MOVE_SELF
+    )
+
+    def __init__(self):
+        Watcher.__init__(self)
+        self._fd = _inotify.init()
+        self._watches = {}
+        self._watched = {}
+        self._standalone_files = set()
+
+    def _add_watch(self, directory):
+        if directory not in self._watched:
+            wd = _inotify.add_watch(self._fd, directory, self._mask)
+            self._watches[wd] = directory
+            self._watched[directory] = wd
+
+    def _remove_watch(self, directory):
+        wd = self._watched.pop(directory, None)
+        if wd is not None:
+            del self._watches[wd]
+            _inotify.rm_watch(self._fd, wd)
+
+    def add_file(self, file):
+        with self._lock:
+            Watcher.add_file(self, file)
+            directory = os.path.dirname(file)
+            if directory not in self.directories:
+                # Files replaced by editors get a new inode, so we watch the
+                # directory instead of the file itself.
+                self._standalone_files.add(file)
+                self._add_watch(directory)
+
+    def add_directory(self, directory, ignore_contained=True):
+        with self._lock:
+            self._add_watch(directory)
+            Watcher.add_directory(
+                self, directory, ignore_contained=ignore_contained
+            )
+
+    def close(self):
+        """
+        Closes the inotify instance. This happens when watching ends, call it
+        yourself, if :meth:`watch` is never called.
+        """
+        os.close(self._fd)
+
+    def watch(self, sleep=0.1):
+        try:
+            while not self._stopped:
+                if select.select([self._fd], [], [], sleep)[0]:
+                    self.process_events(_inotify.read_events(self._fd))
+        finally:
+            self.close()
+
+    def process_events(self, events):
+        with self._lock:
+            for wd, mask, _, name in events:
+                if mask & _inotify.IN_Q_OVERFLOW:
+                    # We missed events, so we have to look for changes.
+                    self.poll()
+                    continue
+                directory = self._watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & _inotify.IN_IGNORED:
+                    self._watches.pop(wd)
+                    self._watched.pop(directory, None)
+                elif name is None:
+                    if mask & (_inotify.IN_DELETE_SELF | _inotify.IN_MOVE_SELF):
+                        # This may arrive before the event for the parent.
+                        self._directory_deleted(
+                            os.path.dirname(directory),
+                            os.path.basename(directory)
+                        )
+                elif mask & (_inotify.IN_CREATE | _inotify.IN_MOVED_TO):
+                    if mask & _inotify.IN_ISDIR:
+                        self._directory_created(directory, name)
                     else:
-                        for path in seen ^ current:
-                            self.directory_modified.send(directory)
-                            if path in current:
-                                if os.path.isfile(path):
-                                    self.add_file(path)
-                                    self.file_added.send(path)
-                                elif os.path.isdir(path):
-                                    new_directories.append(path)
-                                    self.directory_added.send(path)
-                            else:
-                                if os.path.isfile(path):
-                                    self.file_removed.send(path)
-                                    self.files.pop(path)
-                                elif os.path.isdir(path):
-                                    self.directory_removed.send(path)
-                        self.directories[directory] = current
-                for directory in new_directories:
-                    self.add_directory(directory, ignore_contained=False)
-                for directory in removed_directories:
-                    del self.directories[directory]
-                removed_files = []
-                for file, last_known_modified_time in iteritems(self.files):
-                    try:
-                        modified_time = os.stat(file).st_mtime
-                    except OSError as error:
-                        if error.errno == errno.ENOENT:
-                            self.file_removed.send(file)
-                            removed_files.append(file)
-                        else:
-                            raise
+                        self._file_created(directory, name)
+                elif mask & (_inotify.IN_DELETE | _inotify.IN_MOVED_FROM):
+                    if mask & _inotify.IN_ISDIR:
+                        self._directory_deleted(directory, name)
                     else:
-                        if modified_time > last_known_modified_time:
-                            self.files[file] = modified_time
-                            self.file_modified.send(file)
-                            directory = os.path.dirname(file)
-                            if directory in self.directories:
-                                self.directory_modified.send(directory)
-                for file in removed_files:
-                    del self.files[file]
-                time.sleep(sleep)
+                        self._file_deleted(directory, name)
+                elif not mask & _inotify.IN_ISDIR:
+                    self._file_changed(directory, name)
+
+    def _is_relevant(self, directory, path):
+        return (
+            directory in self.directories or path in self._standalone_files
+        )
+
+    def _file_created(self, directory, name):
+        path = os.path.join(directory, name)
+        if not self._is_relevant(directory, path):
+            return
+        if directory in self.directories:
+            self.directories[directory].add(path)
+        if path in self.files:
+            # A known file has been replaced by moving another file over it.
+            self._file_changed(directory, name)
+            return
+        try:
+            Watcher.add_file(self, path)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return
+            raise
+        if directory in self.directories:
+            self.directory_modified.send(directory)
+        self.file_added.send(path)
+
+    def _file_changed(self, directory, name):
+        path = os.path.join(directory, name)
+        if path not in self.files:
+            return
+        try:
+            key = _stat_key(os.stat(path))
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return
+            raise
+        if key != self.files[path]:
+            self.files[path] = key
+            self.file_modified.send(path)
+            if directory in self.directories:
+                self.directory_modified.send(directory)
+
+    def _file_deleted(self, directory, name):
+        path = os.path.join(directory, name)
+        if directory in self.directories:
+            self.directories[directory].discard(path)
+        if path in self.files:
+            del self.files[path]
+            self.file_removed.send(path)
+            if directory in self.directories:
+                self.directory_modified.send(directory)
+
+    def _directory_created(self, directory, name):
+        if directory not in self.directories:
+            return
+        path = os.path.join(directory, name)
+        self.directories[directory].add(path)
+        self.directory_modified.send(directory)
+        if path not in self.directories:
+            self.directory_added.send(path)
+            self._add_tree(path)
+
+    def _add_tree(self, directory):
+        try:
+            self._add_watch(directory)
+            entries = scan(directory)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return
+            raise
+        # Anything that has been created before we started watching the
+        # directory, is reported as added.
+        self.directories[directory] = set()
+        for path, key in sorted(iteritems(entries)):
+            if key is None:
+                self._directory_created(directory, os.path.basename(path))
+            else:
+                self._file_created(directory, os.path.basename(path))
+
+    def _directory_deleted(self, directory, name):
+        path = os.path.join(directory, name)
+        if directory in self.directories:
+            self.directories[directory].discard(path)
+        if path in self.directories:
+            if directory in self.directories:
+                self.directory_modified.send(directory)
+            self._remove_tree(path)
+
+    def _remove_tree(self, directory):
+        prefix = os.path.join(directory, '')
+        removed = [
+            file for file in sorted(self.files)
+            if file.startswith(prefix) and file not in self._standalone_files
+        ]
+        for file in removed:
+            del self.files[file]
+        self.file_removed.send_many(removed)
+        removed = [
+            path for path in sorted(self.directories, reverse=True)
+            if path == directory or path.startswith(prefix)
+        ]
+        for path in removed:
+            del self.directories[path]
+            self._remove_watch(path)
+        self.directory_removed.send_many(removed)
+
+
+def create_watcher(backend='auto', budget=None, directories=(), files=()):
+    """
+    Returns a threaded watcher using the given `backend`, which may be
+    ``'inotify'``, ``'polling'`` or ``'auto'``. The latter uses inotify, if it
+    is available, and falls back to polling otherwise.
+
+    `budget` is the time in seconds a polling watcher may spend on a single
+    poll, see :class:`Watcher`.
+
+    The given `directories` and `files` are added to the watcher. With
+    ``'auto'``, polling is used as well if inotify fails to watch them, for
+    example because the number of watches a user may create is exhausted.
+    """
+    if backend == 'auto':
+        if _inotify.is_available():
+            try:
+                watcher = ThreadedInotifyWatcher()
+            except OSError:
+                pass
+            else:
+                try:
+                    _add_paths(watcher, directories, files)
+                except OSError:
+                    watcher.close()
+                else:
+                    return watcher
+        watcher = ThreadedWatcher(budget=budget)
+    elif backend == 'inotify':
+        watcher = ThreadedInotifyWatcher()
+    elif backend == 'polling':
+        watcher = ThreadedWatcher(budget=budget)
+    else:
+        raise ValueError('unknown watcher backend: %r' % backend)
+    try:
+        _add_paths(watcher, directories, files)
+    except OSError:
+        if isinstance(watcher, InotifyWatcher):
+            watcher.close()
+        raise
+    return watcher
+
+
+def _add_paths(watcher, directories, files):
+    for directory in directories:
+        watcher.add_directory(directory)
+    for file in files:
+        watcher.add_file(file)
 
 
 class ThreadingMixin(object):
@@ -133,3 +827,7 @@ class ThreadingMixin(object):
 
 class ThreadedWatcher(ThreadingMixin, Watcher):
     pass
+
+
+class ThreadedInotifyWatcher(ThreadingMixin, InotifyWatcher):
+    pass
@@ -0,0 +1,4 @@
+from flask import Blueprint
+
+
+admin = Blueprint('admin', 'blueprints.admin', static_folder='static')
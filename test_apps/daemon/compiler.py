@@ -0,0 +1,30 @@
+# coding: utf-8
+"""
+    A compiler daemon, that copies assets to the static folder, upper cases
+    their content and adds its process id.
+"""
+import os
+import sys
+import json
+
+
+def main():
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        if request['asset'].endswith('.crash'):
+            sys.exit(1)
+        if request['asset'].endswith('.fail'):
+            response = {'status': 1, 'error': 'cannot compile'}
+        else:
+            with open(request['asset']) as asset:
+                content = asset.read()
+            with open(request['static'], 'w') as static:
+                static.write(content.upper())
+                static.write('%d\n' % os.getpid())
+            response = {'status': 0}
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,38 @@
 # coding: utf-8
 import os
+import re
 import sys
+import gzip
+import zlib
+import json
+import errno
 import time
 import atexit
 import shutil
 import tempfile
 import unittest
 import threading
+from fnmatch import fnmatch
 from warnings import catch_warnings
 from contextlib import closing, contextmanager
 
-from flask import Flask
+from flask import Flask, Blueprint, url_for
 from werkzeug.exceptions import NotFound
 
-from flask.ext.makestatic import MakeStatic, RuleMissing
+from flask.ext.makestatic import (
+    MakeStatic, RuleMissing, CompilationError, ParsingError, _ConfigParser,
+    _CompileQueue, run_command, run_jobs
+)
 from flask.ext.makestatic._compat import StringIO
-from flask.ext.makestatic.watcher import ThreadedWatcher
+from flask.ext.makestatic import _inotify
+from flask.ext.makestatic.watcher import (
+    Signal, Watcher, ThreadedWatcher, ThreadedInotifyWatcher, Debouncer
+)
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 
 
 TEST_APPS = os.path.join(os.path.dirname(__file__), 'test_apps')
@@ -49,6 +66,16 @@ def bump_modification_time(path):
     os.utime(path, (stat.st_atime, stat.st_mtime + 1))
 
 
+def remove_if_exists(remove, path):
+    # Compilations cancelled by stopping a watcher may still be cleaning up
+    # their staging directory.
+    try:
+        remove(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
 @contextmanager
 def catch_stdout():
     old_stdout = sys.stdout
@@ -61,16 +88,19 @@ def catch_stdout():
 
 class MakeStaticTestCase(unittest.TestCase):
     def tearDown(self):
-        for test_app_dir in os.listdir(TEST_APPS):
-            static_dir = os.path.join(TEST_APPS, test_app_dir, 'static')
+        static_dirs = [
+            os.path.join(root, 'static')
+            for root, dirs, _ in os.walk(TEST_APPS) if 'static' in dirs
+        ]
+        for static_dir in static_dirs:
             if os.path.isdir(static_dir):
                 for root, dirs, files in os.walk(static_dir, topdown=False):
                     for file in files:
                         if file == '.gitignore':
                             continue
-                        os.remove(os.path.join(root, file))
+                        remove_if_exists(os.remove, os.path.join(root, file))
                     for dir in dirs:
-                        os.rmdir(os.path.join(root, dir))
+                        remove_if_exists(os.rmdir, os.path.join(root, dir))
 
     @contextmanager
     def make_static(self, import_name, config=None):
@@ -302,6 +332,53 @@ class MakeStaticTestCase(unittest.TestCase):
                 with closing(client.get('/static/foo')) as response:
                     self.assertEqual(response.status_code, 200)
 
+    def test_watch_reloads_config(self):
+        root_path = os.path.join(get_temporary_directory(), 'working')
+        shutil.copytree(os.path.join(TEST_APPS, 'working'), root_path)
+        app = Flask('working')
+        app.root_path = root_path
+        make_static = MakeStatic(app)
+        watcher = make_static.watch(sleep=0.01)
+        try:
+            foo = os.path.join(app.static_folder, 'foo')
+            bar = os.path.join(app.static_folder, 'bar')
+            with open(foo, 'w') as foo_file:
+                foo_file.write('modified')
+            config_filename = os.path.join(root_path, 'assets.cfg')
+            with open(config_filename) as config_file:
+                config = config_file.read()
+
+            with catch_stdout() as stdout:
+                with open(config_filename, 'w') as config_file:
+                    config_file.write('cp {asset} {static}\n' + config)
+                time.sleep(0.1)
+            self.assertEqual(stdout.getvalue(), (
+                'Flask-MakeStatic: detected change in assets.cfg, reloading\n'
+                'Flask-MakeStatic: failed to reload assets.cfg, expected new '
+                'rule in line 1\n'
+            ))
+            self.assertEqual(make_static.get_commands('bar'), [
+                'cat {asset} | sort > {static}'
+            ])
+
+            with catch_stdout() as stdout:
+                with open(config_filename, 'w') as config_file:
+                    config_file.write(config.replace(
+                        'cat {asset} | sort > {static}',
+                        'cat {asset} > {static}'
+                    ))
+                time.sleep(0.1)
+            self.assertEqual(
+                stdout.getvalue(),
+                'Flask-MakeStatic: detected change in assets.cfg, reloading\n'
+            )
+            with open(bar) as bar_file:
+                self.assertEqual(bar_file.read(), 'def\nabc\n')
+            with open(foo) as foo_file:
+                self.assertEqual(foo_file.read(), 'modified')
+        finally:
+            watcher.stop()
+
     def test_compile(self):
         app = Flask('working')
         make_static = MakeStatic(app)
@@ -346,6 +423,319 @@ class MakeStaticTestCase(unittest.TestCase):
         with closing(client.get('/static/eggs.css')) as response:
             self.assertEqual(response.status_code, 200)
 
+    def test_compile_fingerprint(self):
+        app = Flask('working')
+        app.config['MAKESTATIC_FINGERPRINT'] = True
+        make_static = MakeStatic(app)
+        make_static.compile()
+        static_files = sorted(os.listdir(app.static_folder))
+        make_static.compile()
+        self.assertEqual(sorted(os.listdir(app.static_folder)), static_files)
+
+        with app.test_request_context():
+            url = url_for('static', filename='eggs.css')
+            self.assertTrue(re.match(r'^/static/eggs\.[0-9a-f]{8}\.css$', url))
+        client = app.test_client()
+        with closing(client.get(url)) as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response.headers['Cache-Control'])
+        with closing(client.get('/static/eggs.css')) as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('immutable', response.headers['Cache-Control'])
+
+        # Another application loads the manifest written by compile().
+        other_app = Flask('working')
+        other_app.config['MAKESTATIC_FINGERPRINT'] = True
+        MakeStatic(other_app)
+        with other_app.test_request_context():
+            self.assertEqual(url_for('static', filename='eggs.css'), url)
+
+        # Compiling a single asset, as the watcher does, updates the URL.
+        asset = os.path.join(app.root_path, 'assets', 'eggs.sass')
+        with open(asset) as asset_file:
+            original = asset_file.read()
+        try:
+            with open(asset, 'w') as asset_file:
+                asset_file.write('modified')
+            with app.app_context():
+                make_static.compile_asset(asset)
+            with app.test_request_context():
+                new_url = url_for('static', filename='eggs.css')
+            self.assertNotEqual(new_url, url)
+            with closing(app.test_client().get(new_url)) as response:
+                response.direct_passthrough = False
+                self.assertEqual(response.data, b'modified')
+        finally:
+            with open(asset, 'w') as asset_file:
+                asset_file.write(original)
+
+    def test_compile_precompress(self):
+        app = Flask('working')
+        app.config.update({
+            'MAKESTATIC_PRECOMPRESS': True,
+            'MAKESTATIC_PRECOMPRESS_MIN_SIZE': 1
+        })
+        make_static = MakeStatic(app)
+        make_static.compile()
+        compressed = os.path.join(app.static_folder, 'bar.gz')
+        with closing(gzip.open(compressed)) as compressed_file:
+            self.assertEqual(compressed_file.read(), b'abc\ndef\n')
+        # Empty files are smaller than the minimum size.
+        self.assertFalse(
+            os.path.exists(os.path.join(app.static_folder, 'spam.gz'))
+        )
+
+        # Copies newer than the file they have been created from are kept.
+        future = int(time.time()) + 3600
+        os.utime(compressed, (future, future))
+        make_static.compile()
+        self.assertEqual(os.stat(compressed).st_mtime, future)
+
+        client = app.test_client()
+        with closing(client.get(
+            '/static/bar', headers={'Accept-Encoding': 'gzip'}
+        )) as response:
+            response.direct_passthrough = False
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(
+                zlib.decompress(response.data, 16 + zlib.MAX_WBITS),
+                b'abc\ndef\n'
+            )
+        with closing(client.get('/static/bar')) as response:
+            response.direct_passthrough = False
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.data, b'abc\ndef\n')
+
+        # Compiling a single asset updates its compressed copy.
+        os.utime(compressed, (0, 0))
+        asset = os.path.join(app.root_path, 'assets', 'bar')
+        with open(asset, 'rb') as asset_file:
+            original = asset_file.read()
+        try:
+            with open(asset, 'wb') as asset_file:
+                asset_file.write(b'ghi\n')
+            with app.app_context():
+                make_static.compile_asset(asset)
+            with closing(client.get(
+                '/static/bar', headers={'Accept-Encoding': 'gzip'}
+            )) as response:
+                response.direct_passthrough = False
+                self.assertEqual(
+                    zlib.decompress(response.data, 16 + zlib.MAX_WBITS),
+                    b'ghi\n'
+                )
+        finally:
+            with open(asset, 'wb') as asset_file:
+                asset_file.write(original)
+
+        # Copies older than the file are not served.
+        static = os.path.join(app.static_folder, 'bar')
+        with open(static, 'wb') as static_file:
+            static_file.write(b'jkl\n')
+        os.utime(compressed, (0, 0))
+        with closing(client.get(
+            '/static/bar', headers={'Accept-Encoding': 'gzip'}
+        )) as response:
+            response.direct_passthrough = False
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.data, b'jkl\n')
+
+        with closing(client.get(
+            '/static/missing', headers={'Accept-Encoding': 'gzip'}
+        )) as response:
+            self.assertEqual(response.status_code, 404)
+
+    def test_compile_profile(self):
+        app = Flask('failing')
+        make_static = MakeStatic(app)
+        commands = []
+        make_static.command_executed.connect(commands.append)
+        assets = []
+        make_static.asset_compiled.connect(assets.append)
+        profile = os.path.join(get_temporary_directory(), 'profile.json')
+        with app.app_context():
+            with self.assertRaises(CompilationError):
+                make_static.compile(profile=profile)
+
+        # The command of b is executed with the path of the staging directory.
+        self.assertEqual(
+            sorted((os.path.basename(timing.asset), timing.command.split()[0],
+                    timing.returncode) for timing in commands),
+            [('a', 'false', 1), ('b', 'cp', 0), ('c', 'false', 1)]
+        )
+        timings = dict(
+            (os.path.basename(timing.asset), timing) for timing in assets
+        )
+        self.assertEqual(sorted(timings), ['a', 'b', 'c'])
+        self.assertIsInstance(timings['a'].error, Exception)
+        self.assertIsNone(timings['b'].error)
+        self.assertEqual(timings['b'].rule, 'b')
+        self.assertEqual(
+            timings['b'].output_size,
+            os.path.getsize(os.path.join(app.static_folder, 'b'))
+        )
+        self.assertEqual(len(timings['b'].commands), 1)
+
+        with open(profile) as profile_file:
+            report = json.load(profile_file)
+        self.assertEqual(
+            sorted(asset['asset'] for asset in report['assets']),
+            [os.path.join('assets', name) for name in 'abc']
+        )
+        self.assertEqual(
+            sorted(rule['rule'] for rule in report['rules']), ['a', 'b', 'c']
+        )
+        wall_times = [asset['wall_time'] for asset in report['assets']]
+        self.assertEqual(wall_times, sorted(wall_times, reverse=True))
+        with open(os.path.splitext(profile)[0] + '.txt') as summary_file:
+            summary = summary_file.read()
+        self.assertIn('compiled 3 asset(s)', summary)
+        self.assertIn('assets/a (failed)', summary)
+
+    def test_lazy(self):
+        app = Flask('working')
+        app.config['MAKESTATIC_LAZY'] = True
+        make_static = MakeStatic(app)
+        with app.app_context():
+            watcher = make_static.watch(sleep=0.01)
+        watcher.stop()
+        self.assertEqual(os.listdir(app.static_folder), ['.gitignore'])
+
+        compiled = []
+        compile_asset = make_static.compile_asset
+        def counting_compile_asset(filename, *args, **kwargs):
+            compiled.append(os.path.basename(filename))
+            time.sleep(0.05)
+            return compile_asset(filename, *args, **kwargs)
+        make_static.compile_asset = counting_compile_asset
+
+        client = app.test_client()
+        responses = []
+        def request():
+            with closing(client.get('/static/bar')) as response:
+                response.direct_passthrough = False
+                responses.append(response.data)
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(responses, [b'abc\ndef\n'] * 4)
+        self.assertEqual(compiled, ['bar'])
+
+        with closing(client.get('/static/eggs.css')) as response:
+            self.assertEqual(response.status_code, 200)
+        with closing(client.get('/static/bar')) as response:
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(compiled, ['bar', 'eggs.sass'])
+
+        # Outputs older than their asset are out of date.
+        os.utime(os.path.join(app.static_folder, 'bar'), (0, 0))
+        with closing(client.get('/static/bar')) as response:
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(compiled, ['bar', 'eggs.sass', 'bar'])
+        with closing(client.get('/static/missing')) as response:
+            self.assertEqual(response.status_code, 404)
+
+    def test_compile_blueprints(self):
+        from blueprints import admin
+        app = Flask('blueprints')
+        app.config['MAKESTATIC_FINGERPRINT'] = True
+        make_static = MakeStatic(app)
+        app.register_blueprint(admin, url_prefix='/admin')
+        make_static.compile()
+        self.assertTrue(
+            os.path.isfile(os.path.join(app.static_folder, 'app.txt'))
+        )
+        for filename in ['admin.txt', 'admin.css']:
+            self.assertTrue(
+                os.path.isfile(os.path.join(admin.static_folder, filename))
+            )
+            self.assertFalse(
+                os.path.exists(os.path.join(app.static_folder, filename))
+            )
+
+        with app.test_request_context():
+            url = url_for('admin.static', filename='admin.css')
+        self.assertTrue(
+            re.match(r'^/admin/static/admin\.[0-9a-f]{8}\.css$', url)
+        )
+        with closing(app.test_client().get(url)) as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response.headers['Cache-Control'])
+
+    def test_compile_blueprints_same_package(self):
+        # Blueprints declared in the package of the application share its
+        # assets, instead of compiling them again to their static folder.
+        admin = Blueprint(
+            'admin', 'working', static_folder=get_temporary_directory()
+        )
+        app = Flask('working')
+        make_static = MakeStatic(app)
+        app.register_blueprint(admin, url_prefix='/admin')
+        make_static.compile()
+        self.assertTrue(
+            os.path.isfile(os.path.join(app.static_folder, 'foo'))
+        )
+        self.assertEqual(os.listdir(admin.static_folder), [])
+        self.assertEqual(
+            [tree.name for tree in make_static._get_trees(app)], [None]
+        )
+
+    def test_watch_blueprints(self):
+        from blueprints import admin
+        app = Flask('blueprints')
+        app.register_blueprint(admin, url_prefix='/admin')
+        make_static = MakeStatic(app)
+        with app.app_context():
+            watcher = make_static.watch(sleep=0.01)
+        try:
+            static = os.path.join(admin.static_folder, 'admin.txt')
+            os.remove(static)
+            with catch_stdout() as stdout:
+                bump_modification_time(
+                    os.path.join(admin.root_path, 'assets', 'admin.txt')
+                )
+                time.sleep(0.1)
+            self.assertEqual(
+                stdout.getvalue(),
+                'Flask-MakeStatic: detected change in admin.txt (admin), '
+                'compiling\n'
+            )
+            self.assertTrue(os.path.isfile(static))
+        finally:
+            watcher.stop()
+
+    def test_lazy_blueprints(self):
+        from blueprints import admin
+        app = Flask('blueprints')
+        app.config['MAKESTATIC_LAZY'] = True
+        app.config['MAKESTATIC_PRECOMPRESS'] = True
+        app.config['MAKESTATIC_PRECOMPRESS_MIN_SIZE'] = 1
+        MakeStatic(app)
+        app.register_blueprint(admin, url_prefix='/admin')
+
+        client = app.test_client()
+        for filename in ['admin.txt', 'admin.css']:
+            with closing(client.get('/admin/static/' + filename)) as response:
+                self.assertEqual(response.status_code, 200)
+            self.assertTrue(
+                os.path.isfile(os.path.join(admin.static_folder, filename))
+            )
+        with closing(client.get('/static/app.txt')) as response:
+            self.assertEqual(response.status_code, 200)
+        with closing(client.get('/admin/static/app.txt')) as response:
+            self.assertEqual(response.status_code, 404)
+
+        self.assertTrue(
+            os.path.isfile(os.path.join(admin.static_folder, 'admin.txt.gz'))
+        )
+        with closing(client.get(
+            '/admin/static/admin.txt', headers={'Accept-Encoding': 'gzip'}
+        )) as response:
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
     def test_compile_globbing(self):
         app = Flask('working_globbing')
         app.config['MAKESTATIC_FILEPATTERN_FORMAT'] = 'globbing'
@@ -368,6 +758,353 @@ class MakeStaticTestCase(unittest.TestCase):
         with closing(client.get('/static/eggs.css')) as response:
             self.assertEqual(response.status_code, 200)
 
+    def test_compile_parallel(self):
+        app = Flask('working')
+        app.config['MAKESTATIC_JOBS'] = 4
+        make_static = MakeStatic(app)
+        make_static.compile()
+
+        client = app.test_client()
+        for filename in ['foo', 'spam', 'bar', 'eggs.css', 'subdirectory/blubb']:
+            with closing(client.get('/static/' + filename)) as response:
+                self.assertEqual(response.status_code, 200)
+
+    def test_compile_collects_errors(self):
+        app = Flask('failing')
+        make_static = MakeStatic(app)
+        try:
+            make_static.compile(jobs=3)
+        except CompilationError as error:
+            self.assertEqual(
+                [os.path.basename(filename) for filename, _ in error.failures],
+                ['a', 'c']
+            )
+        else:
+            self.fail('CompilationError not raised')
+        self.assertTrue(os.path.isfile(os.path.join(app.static_folder, 'b')))
+
+    def test_compile_fail_fast(self):
+        app = Flask('failing')
+        make_static = MakeStatic(app)
+        try:
+            make_static.compile(fail_fast=True)
+        except CompilationError as error:
+            self.assertEqual(
+                [os.path.basename(filename) for filename, _ in error.failures],
+                ['a']
+            )
+        else:
+            self.fail('CompilationError not raised')
+        self.assertFalse(os.path.exists(os.path.join(app.static_folder, 'b')))
+
+        # Concurrently compiled assets report the same failure.
+        try:
+            make_static.compile(jobs=3, fail_fast=True)
+        except CompilationError as error:
+            self.assertEqual(
+                [os.path.basename(filename) for filename, _ in error.failures],
+                ['a']
+            )
+        else:
+            self.fail('CompilationError not raised')
+
+    def test_run_jobs_fail_fast(self):
+        called = []
+        def function(argument):
+            # The first failure in the order of the arguments happens last.
+            if argument == 1:
+                time.sleep(0.05)
+            called.append(argument)
+            if argument in (1, 2):
+                raise ValueError(argument)
+        failures = run_jobs(function, range(6), jobs=3, fail_fast=True)
+        self.assertEqual(
+            [(argument, error.args) for argument, error in failures],
+            [(1, (1, ))]
+        )
+        self.assertEqual(sorted(called)[:3], [0, 1, 2])
+        self.assertNotIn(4, called)
+        self.assertNotIn(5, called)
+
+    def test_compile_atomic_writes(self):
+        app = Flask('partial')
+        make_static = MakeStatic(app)
+        static = os.path.join(app.static_folder, 'a')
+        with open(static, 'w') as static_file:
+            static_file.write('old\n')
+        self.assertRaises(CompilationError, make_static.compile)
+        with open(static) as static_file:
+            self.assertEqual(static_file.read(), 'old\n')
+        self.assertEqual(
+            sorted(os.listdir(app.static_folder)), ['.gitignore', 'a']
+        )
+
+        app.config['MAKESTATIC_ATOMIC_WRITES'] = False
+        self.assertRaises(CompilationError, make_static.compile)
+        with open(static) as static_file:
+            self.assertEqual(static_file.read(), 'new\n')
+
+        # Commands can read files compiled before from the static folder.
+        root = get_temporary_directory()
+        os.mkdir(os.path.join(root, 'assets'))
+        for name in ['a.css', 'bundle']:
+            open(os.path.join(root, 'assets', name), 'w').close()
+        with open(os.path.join(root, 'assets', 'a.css'), 'w') as asset:
+            asset.write('a\n')
+        with open(os.path.join(root, 'assets.cfg'), 'w') as config:
+            config.write(
+                '[a.css]\n'
+                'cp {asset} {static}\n'
+                '[bundle]\n'
+                'cat {static_dir}/a.css > {static_dir}/bundle.css\n'
+            )
+        app = Flask('bundle', static_folder=os.path.join(root, 'static'))
+        app.root_path = root
+        MakeStatic(app).compile()
+        with open(os.path.join(root, 'static', 'bundle.css')) as bundle:
+            self.assertEqual(bundle.read(), 'a\n')
+
+        # Directories nothing has been written to are not created.
+        app = Flask('dependencies')
+        MakeStatic(app).compile()
+        self.assertFalse(
+            os.path.exists(os.path.join(app.static_folder, 'partials'))
+        )
+
+    def test_compile_daemon(self):
+        app = Flask('daemon')
+        app.config['MAKESTATIC_DAEMONS'] = 1
+        make_static = MakeStatic(app)
+        try:
+            make_static.compile()
+        except CompilationError as error:
+            self.assertEqual(
+                [os.path.basename(filename) for filename, _ in error.failures],
+                ['b.crash', 'd.fail']
+            )
+        else:
+            self.fail('CompilationError not raised')
+        pids = []
+        for filename in ['a.txt', 'c.txt']:
+            with open(os.path.join(app.static_folder, filename)) as file:
+                content, pid = file.read().splitlines()
+            self.assertEqual(content, 'SPAM')
+            pids.append(pid)
+        # The daemon crashed while compiling b.crash and has been restarted.
+        self.assertNotEqual(pids[0], pids[1])
+
+        os.remove(os.path.join(app.static_folder, 'c.txt'))
+        with app.app_context():
+            make_static.compile_asset(
+                os.path.join(make_static.assets_folder, 'c.txt')
+            )
+        with open(os.path.join(app.static_folder, 'c.txt')) as file:
+            self.assertEqual(file.read().splitlines()[1], pids[1])
+
+        # Reloading the configuration stops the daemons of the tree and
+        # closes their pipes.
+        pool = app.extensions['MakeStatic'].get_daemon_pool(
+            'python %s' % os.path.join(app.root_path, 'compiler.py'), 1
+        )
+        process = pool._idle[0]
+        with app.app_context():
+            make_static.reload_config()
+        self.assertIsNotNone(process.returncode)
+        self.assertTrue(process.stdin.closed)
+        self.assertTrue(process.stdout.closed)
+
+    def test_compile_incremental(self):
+        app = Flask('working')
+        make_static = MakeStatic(app)
+        make_static.compile(incremental='mtime')
+
+        output = os.path.join(app.static_folder, 'eggs.css')
+        with open(output, 'w') as output_file:
+            output_file.write('modified')
+        make_static.compile(incremental='mtime')
+        with open(output) as output_file:
+            self.assertEqual(output_file.read(), 'modified')
+
+        os.utime(output, (0, 0))
+        make_static.compile(incremental='mtime')
+        with open(output) as output_file:
+            self.assertNotEqual(output_file.read(), 'modified')
+
+        # Rules without outputs compile to the file named after the asset.
+        foo = os.path.join(app.static_folder, 'foo')
+        bar = os.path.join(app.static_folder, 'bar')
+        for output in [foo, bar]:
+            with open(output, 'w') as output_file:
+                output_file.write('modified')
+        make_static.compile(incremental='mtime')
+        for output in [foo, bar]:
+            with open(output) as output_file:
+                self.assertEqual(output_file.read(), 'modified')
+
+        os.utime(bar, (0, 0))
+        make_static.compile(incremental='mtime')
+        with open(foo) as output_file:
+            self.assertEqual(output_file.read(), 'modified')
+        with open(bar) as output_file:
+            self.assertEqual(output_file.read(), 'abc\ndef\n')
+
+    def test_compile_incremental_hash(self):
+        app = Flask('working')
+        make_static = MakeStatic(app)
+        make_static.compile(incremental='hash')
+        self.assertTrue(os.path.isfile(
+            os.path.join(app.static_folder, '.makestatic-manifest.json')
+        ))
+
+        foo = os.path.join(app.static_folder, 'foo')
+        bar = os.path.join(app.static_folder, 'bar')
+        for output in [foo, bar]:
+            with open(output, 'w') as output_file:
+                output_file.write('modified')
+        make_static.compile(incremental='hash')
+        for output in [foo, bar]:
+            with open(output) as output_file:
+                self.assertEqual(output_file.read(), 'modified')
+
+        with app.open_resource('assets.cfg', 'r') as config_file:
+            config = config_file.read()
+        app.extensions['MakeStatic'].set_matcher(_ConfigParser(
+            StringIO(config.replace('touch {static_dir}/spam', 'true')),
+            'regex'
+        ).parse())
+        make_static.compile(incremental='hash')
+        with open(foo) as output_file:
+            self.assertEqual(output_file.read(), 'foo\n')
+        with open(bar) as output_file:
+            self.assertEqual(output_file.read(), 'modified')
+
+        # The rule of bar does not declare its outputs, the file with the
+        # name of the asset is rebuilt, if it is missing.
+        os.remove(bar)
+        make_static.compile(incremental='hash')
+        with open(bar) as output_file:
+            self.assertEqual(output_file.read(), 'abc\ndef\n')
+
+    def test_compile_incremental_dependencies(self):
+        app = Flask('dependencies')
+        make_static = MakeStatic(app)
+        make_static.compile(incremental='mtime')
+
+        outputs = [
+            os.path.join(app.static_folder, 'main.css'),
+            os.path.join(app.static_folder, 'other.css')
+        ]
+        for output in outputs:
+            with open(output, 'w') as output_file:
+                output_file.write('modified')
+        colors = os.path.join(
+            make_static.assets_folder, 'partials', '_colors.scss'
+        )
+        os.utime(colors, (time.time() + 10, time.time() + 10))
+        make_static.compile(incremental='mtime')
+        with open(outputs[0]) as output_file:
+            self.assertNotEqual(output_file.read(), 'modified')
+        with open(outputs[1]) as output_file:
+            self.assertEqual(output_file.read(), 'modified')
+
+    def test_watch_dependencies(self):
+        with self.make_static('dependencies') as (app, make_static):
+            outputs = [
+                os.path.join(app.static_folder, 'main.css'),
+                os.path.join(app.static_folder, 'other.css')
+            ]
+            for output in outputs:
+                with open(output, 'w') as output_file:
+                    output_file.write('modified')
+            with catch_stdout():
+                bump_modification_time(os.path.join(
+                    make_static.assets_folder, 'partials', '_colors.scss'
+                ))
+                time.sleep(0.2)
+            with open(outputs[0]) as output_file:
+                self.assertNotEqual(output_file.read(), 'modified')
+            with open(outputs[1]) as output_file:
+                self.assertEqual(output_file.read(), 'modified')
+
+    def test_rule_cache(self):
+        app = Flask('working')
+        app.config['MAKESTATIC_RULE_CACHE_SIZE'] = 2
+        make_static = MakeStatic(app)
+        self.assertEqual(make_static.rule_cache_info(), (0, 0, 2, 0))
+        rule = make_static.get_rule('foo')
+        self.assertTrue(make_static.get_rule('foo') is rule)
+        self.assertEqual(make_static.get_rule('spam.txt'), None)
+        self.assertEqual(make_static.get_rule('spam.txt'), None)
+        self.assertEqual(make_static.rule_cache_info(), (2, 2, 2, 2))
+        make_static.get_rule('bar')
+        self.assertEqual(make_static.rule_cache_info(), (2, 3, 2, 2))
+        make_static.get_rule('foo')
+        self.assertEqual(make_static.rule_cache_info(), (2, 4, 2, 2))
+
+        state = app.extensions['MakeStatic']
+        state.set_matcher(state.matcher)
+        self.assertEqual(make_static.rule_cache_info(), (0, 0, 2, 0))
+
+    def test_config_cache(self):
+        from flask.ext import makestatic
+        cache_directory = get_temporary_directory()
+        config = {'MAKESTATIC_CONFIG_CACHE': cache_directory}
+        makestatic._matchers.clear()
+        app = Flask('working')
+        app.config.update(config)
+        MakeStatic(app)
+        self.assertEqual(len(os.listdir(cache_directory)), 1)
+
+        makestatic._matchers.clear()
+        def parse_rules(self):
+            raise AssertionError('configuration has been parsed')
+        def split_command(command):
+            raise AssertionError('command has been split')
+        original_parse_rules = _ConfigParser.parse_rules
+        original_split_command = makestatic._split_command
+        _ConfigParser.parse_rules = parse_rules
+        makestatic._split_command = split_command
+        try:
+            app = Flask('working')
+            app.config.update(config)
+            make_static = MakeStatic(app)
+            self.assertEqual(make_static.get_commands('foo'), [
+                'cp {asset} {static}', 'touch {static_dir}/spam'
+            ])
+            make_static.compile()
+            for filename in ['foo', 'spam', 'bar']:
+                self.assertTrue(
+                    os.path.isfile(os.path.join(app.static_folder, filename))
+                )
+            # Once loaded, the matcher is reused by applications using the
+            # same configuration.
+            make_static = MakeStatic(Flask('working'))
+            self.assertEqual(make_static.get_commands('bar'), [
+                'cat {asset} | sort > {static}'
+            ])
+        finally:
+            _ConfigParser.parse_rules = original_parse_rules
+            makestatic._split_command = original_split_command
+
+        # Caches that cannot be loaded are ignored.
+        cache_filename = os.path.join(
+            cache_directory, os.listdir(cache_directory)[0]
+        )
+        for content in [
+            b'garbage', b'[["pattern", "commands", {}]]',
+            b'[["bar", ["cat {asset}"], {}]]',
+            b'[["bar", ["@rm {asset}"], {}, [["rm", ["{asset}"]]]]]'
+        ]:
+            with open(cache_filename, 'wb') as cache_file:
+                cache_file.write(content)
+            makestatic._matchers.clear()
+            app = Flask('working')
+            app.config.update(config)
+            make_static = MakeStatic(app)
+            self.assertEqual(make_static.get_commands('bar'), [
+                'cat {asset} | sort > {static}'
+            ])
+
     def test_compile_warns_on_missing_rule(self):
         app = Flask('missing_rule')
         make_static = MakeStatic(app)
@@ -385,7 +1122,151 @@ class MakeStaticTestCase(unittest.TestCase):
         self.assertRaises(RuntimeError, make_static.compile)
 
 
+class ConfigParserTestCase(unittest.TestCase):
+    def parse(self, source, filepattern_format='regex'):
+        return _ConfigParser(StringIO(source), filepattern_format).parse()
+
+    def test_options(self):
+        get_rule = self.parse(
+            '[.*\\.sass]\n'
+            ':outputs {static_base}.css {static_base}.css.map\n'
+            'sass {asset} {static_base}.css\n'
+        )
+        rule = get_rule('foo.sass')
+        self.assertEqual(rule.commands, ['sass {asset} {static_base}.css'])
+        self.assertEqual(
+            rule.outputs, ['{static_base}.css', '{static_base}.css.map']
+        )
+
+    def test_command_templates(self):
+        rule = self.parse(
+            '[.*]\n'
+            'cp "{asset}" {static}\n'
+            'cat {asset} | sort > {static}\n'
+        )('foo bar')
+        direct, shell = rule.command_templates
+        self.assertEqual(
+            direct.format(asset='foo bar', static='static/foo bar'),
+            ['cp', 'foo bar', 'static/foo bar']
+        )
+        self.assertEqual(
+            shell.format(asset='foo', static='static/foo'),
+            'cat foo | sort > static/foo'
+        )
+
+    def test_run_command_path_with_spaces(self):
+        directory = get_temporary_directory()
+        asset = os.path.join(directory, 'foo bar')
+        static = os.path.join(directory, 'static foo bar')
+        with open(asset, 'w') as asset_file:
+            asset_file.write('spam')
+        template = self.parse('[.*]\ncp {asset} {static}\n')(
+            'foo bar'
+        ).command_templates[0]
+        run_command(template.format(asset=asset, static=static))
+        with open(static) as static_file:
+            self.assertEqual(static_file.read(), 'spam')
+
+    def test_actions(self):
+        directory = get_temporary_directory()
+        asset = os.path.join(directory, 'asset')
+        with open(asset, 'w') as asset_file:
+            asset_file.write('spam\n')
+        os.chmod(asset, 0o750)
+        rule = self.parse(
+            '[.*]\n'
+            '@mkdir {static_dir}/a/b {static_dir}/a/b\n'
+            '@copy {asset} {static_dir}/a/b/copy\n'
+            '@concat {asset} {static_dir}/a/b/copy {static}\n'
+        )('asset')
+        for command in rule.command_templates:
+            command.run(
+                asset=asset, static_dir=directory,
+                static=os.path.join(directory, 'concatenated')
+            )
+        copy = os.path.join(directory, 'a', 'b', 'copy')
+        with open(copy) as copy_file:
+            self.assertEqual(copy_file.read(), 'spam\n')
+        self.assertEqual(os.stat(copy).st_mode & 0o777, 0o750)
+        with open(os.path.join(directory, 'concatenated')) as static_file:
+            self.assertEqual(static_file.read(), 'spam\nspam\n')
+
+    def test_invalid_action(self):
+        for source, message in [
+            ('[.*]\n@move {asset} {static}\n', 'unknown action @move'),
+            ('[.*]\n@copy {asset}\n', 'wrong number of arguments for @copy')
+        ]:
+            try:
+                self.parse(source)
+            except ParsingError as error:
+                self.assertEqual(error.message, message)
+                self.assertEqual(error.lineno, 2)
+            else:
+                self.fail('ParsingError not raised')
+
+    def test_globbing(self):
+        patterns = [
+            'foo', '*.sass', 'sub/*', '*.tar.gz', '*.s?ss', '.*', '*.css',
+            'a?c.css', '*'
+        ]
+        get_rule = self.parse(
+            ''.join('[%s]\ntrue\n' % pattern for pattern in patterns),
+            'globbing'
+        )
+        for filename in [
+            'foo', 'foo.sass', 'sub/foo.sass', 'sub/foo', 'a.tar.gz', 'b.gz',
+            'a.scss', '.bashrc', 'abc.css', 'sub/abc.css', 'bar'
+        ]:
+            expected = [
+                pattern for pattern in patterns if fnmatch(filename, pattern)
+            ][0]
+            self.assertEqual(get_rule(filename).pattern, expected)
+
+        get_rule = self.parse('[*.css]\ntrue\n', 'globbing')
+        self.assertEqual(get_rule('foo.sass'), None)
+
+    def test_globbing_many_rules(self):
+        get_rule = self.parse(
+            ''.join('[*.%d]\ntrue\n[%d/*]\ntrue\n' % (i, i) for i in range(500)),
+            'globbing'
+        )
+        self.assertEqual(get_rule('foo.321').pattern, '*.321')
+        self.assertEqual(get_rule('321/foo').pattern, '321/*')
+        self.assertEqual(get_rule('321/foo.123').pattern, '*.123')
+
+    def test_invalid_scan_option(self):
+        try:
+            self.parse('[foo]\n:scan (\n')
+        except ParsingError as error:
+            self.assertTrue(
+                error.message.startswith('invalid regular expression')
+            )
+            self.assertEqual(error.lineno, 2)
+        else:
+            self.fail('ParsingError not raised')
+
+    def test_expected_new_rule(self):
+        try:
+            self.parse('# comment\n\ncp {asset} {static}\n[foo]\n')
+        except ParsingError as error:
+            self.assertEqual(error.message, 'expected new rule')
+            self.assertEqual(error.lineno, 3)
+        else:
+            self.fail('ParsingError not raised')
+
+    def test_unknown_option(self):
+        try:
+            self.parse('[foo]\ntrue\n[bar]\n:spam eggs\n')
+        except ParsingError as error:
+            self.assertEqual(error.message, 'unknown option spam')
+            self.assertEqual(error.lineno, 4)
+        else:
+            self.fail('ParsingError not raised')
+
+
 class WatcherTestCase(unittest.TestCase):
+    watcher_class = ThreadedWatcher
+
     def assert_(self, **kwargs):
         self.assertEqual(self.added_files, kwargs.pop('added_files', []))
         del self.added_files[:]
@@ -409,7 +1290,7 @@ class WatcherTestCase(unittest.TestCase):
             )
 
     def test(self):
-        watcher = ThreadedWatcher()
+        watcher = self.watcher_class()
         self.added_files = []
         self.modified_files = []
         self.removed_files = []
@@ -467,11 +1348,247 @@ class WatcherTestCase(unittest.TestCase):
         time.sleep(0.05)
         self.assertEqual(threading.active_count(), 1)
 
+    def test_modification_without_mtime_change(self):
+        watcher = self.watcher_class()
+        modified_files = []
+        watcher.file_modified.connect(modified_files.append)
+
+        directory = get_temporary_directory()
+        foo = os.path.join(directory, 'foo')
+        open(foo, 'w').close()
+        stat = os.stat(foo)
+        watcher.add_directory(directory)
+        watcher.watch(sleep=0.01)
+        try:
+            with open(foo, 'w') as foo_file:
+                foo_file.write('foo')
+            os.utime(foo, (stat.st_atime, stat.st_mtime))
+            time.sleep(0.05)
+            # The watcher may poll between writing and resetting the
+            # modification time, in which case it reports both changes.
+            self.assertEqual(set(modified_files), set([foo]))
+        finally:
+            watcher.stop()
+
+
+class InotifyWatcherTestCase(WatcherTestCase):
+    watcher_class = ThreadedInotifyWatcher
+
+    def test_watch_exhausted(self):
+        def add_watch(fd, path, mask):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        original_add_watch = _inotify.add_watch
+        _inotify.add_watch = add_watch
+        try:
+            app = Flask('working')
+            app.config['MAKESTATIC_LAZY'] = True
+            make_static = MakeStatic(app)
+            watcher = make_static.watch(sleep=0.01)
+            try:
+                self.assertNotIsInstance(watcher, ThreadedInotifyWatcher)
+                self.assertIsInstance(watcher, ThreadedWatcher)
+            finally:
+                watcher.stop()
+
+            # Without a fallback, no threads are left behind.
+            app.config['MAKESTATIC_WATCHER'] = 'inotify'
+            threads = set(threading.enumerate())
+            with self.assertRaises(OSError):
+                make_static.watch(sleep=0.01)
+            self.assertEqual(set(threading.enumerate()) - threads, set())
+        finally:
+            _inotify.add_watch = original_add_watch
+
+
+class PollingWatcherTestCase(unittest.TestCase):
+    def test_poll_budget(self):
+        watcher = Watcher()
+        added_files = []
+        watcher.file_added.connect(added_files.append)
+        modified_files = []
+        watcher.file_modified.connect(modified_files.append)
+
+        directory = get_temporary_directory()
+        for name in 'abc':
+            os.mkdir(os.path.join(directory, name))
+        watcher.add_directory(directory)
+        foo = os.path.join(directory, 'a', 'foo')
+        open(foo, 'w').close()
+        bar = os.path.join(directory, 'c', 'bar')
+        open(bar, 'w').close()
+
+        # A budget of zero examines one directory per poll.
+        passes = [watcher.poll(budget=0) for _ in range(4)]
+        self.assertEqual(passes, [False, False, False, True])
+        self.assertEqual(sorted(added_files), [foo, bar])
+
+        bump_modification_time(foo)
+        passes = [watcher.poll(budget=0) for _ in range(4)]
+        self.assertEqual(passes, [False, False, False, True])
+        self.assertEqual(modified_files, [foo])
+
+        # Without a budget a complete pass is made.
+        del added_files[:]
+        baz = os.path.join(directory, 'b', 'baz')
+        open(baz, 'w').close()
+        self.assertTrue(watcher.poll())
+        self.assertEqual(added_files, [baz])
+
+
+class SignalTestCase(unittest.TestCase):
+    def test_inline(self):
+        signal = Signal()
+        calls = []
+        @signal.connect
+        def listener(*args, **kwargs):
+            calls.append((args, kwargs))
+        signal.send(1, foo=2)
+        signal.send_many([3, 4])
+        self.assertEqual(calls, [((1, ), {'foo': 2}), ((3, ), {}), ((4, ), {})])
+        signal.disconnect(listener)
+        signal.send(5)
+        self.assertEqual(len(calls), 3)
+        self.assertRaises(ValueError, signal.disconnect, listener)
+
+    def test_thread(self):
+        signal = Signal()
+        calls = []
+        finished = threading.Event()
+        @signal.connect(mode='thread')
+        def listener(item):
+            time.sleep(0.01)
+            calls.append((item, threading.current_thread()))
+            if item == 9:
+                finished.set()
+        start = time.time()
+        for item in range(5):
+            signal.send(item)
+        signal.send_many(range(5, 10))
+        # Sending does not wait for the listener.
+        self.assertLess(time.time() - start, 0.05)
+        finished.wait(1)
+        self.assertEqual([item for item, _ in calls], list(range(10)))
+        self.assertNotIn(threading.current_thread(),
+                         [thread for _, thread in calls])
+        # The threads of the pool exit, once there is nothing left to do.
+        time.sleep(0.05)
+        self.assertEqual(threading.active_count(), 1)
+
+    def test_weak(self):
+        class Listener(object):
+            def __init__(self):
+                self.calls = []
+
+            def __call__(self, item):
+                self.calls.append(item)
+
+            def method(self, item):
+                self.calls.append(item)
+        signal = Signal()
+        function = Listener()
+        instance = Listener()
+        signal.connect(function, weak=True)
+        signal.connect(instance.method, weak=True)
+        signal.send(1)
+        self.assertEqual(function.calls, [1])
+        self.assertEqual(instance.calls, [1])
+        del function, instance
+        self.assertEqual(signal.listeners, [])
+
+    def test_batch(self):
+        signal = Signal()
+        batches = []
+        signal.connect(batches.append, batch=True)
+        signal.send_many(['a', 'b'])
+        signal.send('c')
+        signal.send('d', 'e')
+        signal.send_many([])
+        self.assertEqual(batches, [['a', 'b'], ['c'], [('d', 'e')]])
+
+    def test_asyncio(self):
+        if asyncio is None:
+            return
+        loop = asyncio.new_event_loop()
+        try:
+            signal = Signal()
+            calls = []
+            signal.connect(calls.append, mode='asyncio', loop=loop)
+            future = asyncio.Future(loop=loop)
+            def send():
+                signal.send(1)
+                signal.send_many([2, 3])
+                loop.call_soon_threadsafe(future.set_result, None)
+            thread = threading.Thread(target=send)
+            thread.start()
+            loop.run_until_complete(future)
+            thread.join()
+            self.assertEqual(calls, [1, 2, 3])
+        finally:
+            loop.close()
+        # Listeners are disconnected, once their loop is closed.
+        signal.send(4)
+        self.assertEqual(signal.listeners, [])
+
+
+class DebouncerTestCase(unittest.TestCase):
+    def test(self):
+        batches = []
+        debouncer = Debouncer(batches.append, delay=0.05)
+        try:
+            self.assertTrue(debouncer.add('foo', 'added'))
+            self.assertFalse(debouncer.add('foo', 'modified'))
+            self.assertTrue(debouncer.add('bar', 'modified'))
+            debouncer.add('bar', 'modified')
+            debouncer.add('baz', 'added')
+            debouncer.add('baz', 'removed')
+            debouncer.add('spam', 'removed')
+            debouncer.add('spam', 'added')
+            self.assertEqual(batches, [])
+            time.sleep(0.1)
+            self.assertEqual(batches, [{
+                'foo': 'added', 'bar': 'modified', 'spam': 'modified'
+            }])
+        finally:
+            debouncer.stop()
+
+
+class CompileQueueTestCase(unittest.TestCase):
+    def test_supersede(self):
+        started = []
+        finished = []
+        errors = []
+        def compile(filename):
+            started.append(filename)
+            run_command('sleep 5' if len(started) == 1 else 'true')
+            finished.append(filename)
+        queue = _CompileQueue(
+            compile, lambda filename, error: errors.append(error), jobs=1
+        )
+        try:
+            queue.submit('a')
+            time.sleep(0.05)
+            queue.submit('b')
+            queue.submit('b')
+            queue.submit('a')
+            time.sleep(0.2)
+            self.assertEqual(started, ['a', 'b', 'a'])
+            self.assertEqual(finished, ['b', 'a'])
+            self.assertEqual(errors, [])
+        finally:
+            queue.stop()
+
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(MakeStaticTestCase))
+    suite.addTest(unittest.makeSuite(ConfigParserTestCase))
     suite.addTest(unittest.makeSuite(WatcherTestCase))
+    suite.addTest(unittest.makeSuite(PollingWatcherTestCase))
+    suite.addTest(unittest.makeSuite(SignalTestCase))
+    suite.addTest(unittest.makeSuite(DebouncerTestCase))
+    suite.addTest(unittest.makeSuite(CompileQueueTestCase))
+    if _inotify.is_available():
+        suite.addTest(unittest.makeSuite(InotifyWatcherTestCase))
     return suite
 
 